@@ -130,11 +130,6 @@ if __name__ == "__main__":
                 print("Done: ", i); sys.stdout.flush()
 
                 vardict = []
-                vardir = os.path.join(os.path.dirname(timefile), "{0}".format(i))
-                varfile = os.path.join(vardir, "variables.json")
-                if not os.path.exists(vardir):
-                    os.makedirs(vardir)
-                
                 tarargs = []
                 allfiles = []
                 allgroups = []
@@ -151,6 +146,15 @@ if __name__ == "__main__":
                         for j in range(len(files)):
                             allgroups += [name]
 
+                # Plotters that skip ahead leave steps without any images; only the newest step goes on regardless
+                if (len(tarargs) == 0) and (i < minfound):
+                    continue
+
+                vardir = os.path.join(os.path.dirname(timefile), "{0}".format(i))
+                varfile = os.path.join(vardir, "variables.json")
+                if not os.path.exists(vardir):
+                    os.makedirs(vardir)
+
                 for filename, groupname in zip(allfiles, allgroups):
                     fname = os.path.basename(filename)
                     name, ext = os.path.splitext(fname)
@@ -7,6 +7,15 @@ import adios2
 
 import sys
 import time
+import heapq
+import threading
+import warnings
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import zlib
+import struct
 import kittie_common
 
 
@@ -28,6 +37,91 @@ def ShapeParse(xShape, xsel):
     return starts, counts
 
 
+def Partition(costs, size):
+    """ Greedy longest-processing-time: most expensive first, each onto whichever rank has the least so far """
+    loads = [(0.0, i) for i in range(size)]
+    parts = []
+    for i in range(size):
+        parts += [[]]
+    for name in sorted(costs.keys(), key=lambda name: -costs[name]):
+        load, i = heapq.heappop(loads)
+        parts[i] += [name]
+        heapq.heappush(loads, (load + costs[name], i))
+    return parts
+
+
+def Downsample(data, resolution):
+    """
+    Average blocks of pixels together until neither side is bigger than resolution (0 leaves it alone).
+    Each axis has its own block size, and the blocks left over at the ends are averaged over the pixels they have.
+    """
+    if (resolution is None) or (resolution <= 0):
+        return data
+    ny, nx = data.shape
+    fy = min(max(int(np.ceil(ny / float(resolution))), 1), ny)
+    fx = min(max(int(np.ceil(nx / float(resolution))), 1), nx)
+    if (fy == 1) and (fx == 1):
+        return data
+
+    by = -(-ny // fy)
+    bx = -(-nx // fx)
+    total = np.pad(data, ((0, by*fy - ny), (0, bx*fx - nx))).reshape(by, fy, bx, fx).sum(axis=(1, 3))
+    cy = np.full(by, fy)
+    cy[-1] = ny - fy*(by - 1)
+    cx = np.full(bx, fx)
+    cx[-1] = nx - fx*(bx - 1)
+    return total / np.outer(cy, cx)
+
+
+def ColorImage(data, cmap, vmin=None, vmax=None, origin="lower"):
+    """ RGBA bytes for a 2D array, looked up straight from the colormap's table instead of going through a figure """
+    import matplotlib.pyplot as plt
+
+    data = np.asarray(data, dtype=np.float64)
+    if vmin is None:
+        vmin = np.nanmin(data)
+    if vmax is None:
+        vmax = np.nanmax(data)
+    scale = 255.0 / max(vmax - vmin, 1e-300)
+
+    table = plt.get_cmap(cmap)(np.linspace(0, 1, 256), bytes=True)
+    index = np.clip((np.nan_to_num(data, nan=vmin) - vmin) * scale, 0, 255).astype(np.uint8)
+    rgba = table[index]
+    rgba[np.isnan(data), 3] = 0
+
+    # Images are written top row first
+    if origin == "lower":
+        rgba = rgba[::-1]
+    return np.ascontiguousarray(rgba)
+
+
+def WritePNG(filename, rgba, level=3):
+    """ 8-bit RGBA PNG, with no filtering, so it's nothing more than zlib on the rows """
+
+    def chunk(tag, body):
+        return struct.pack(">I", len(body)) + tag + body + struct.pack(">I", zlib.crc32(tag + body) & 0xffffffff)
+
+    height, width = rgba.shape[:2]
+    rows = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    rows[:, 1:] = rgba.reshape(height, width * 4)
+
+    with open(filename, 'wb') as outfile:
+        outfile.write(b"\x89PNG\r\n\x1a\n")
+        outfile.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)))
+        outfile.write(chunk(b"IDAT", zlib.compress(rows.tobytes(), level)))
+        outfile.write(chunk(b"IEND", b""))
+
+
+def WriteRaster(filename, data, cmap, vmin=None, vmax=None, resolution=0, origin="lower"):
+    """ Colormapped image file of a 2D array, without matplotlib drawing anything; WebP needs Pillow """
+    rgba = ColorImage(Downsample(data, resolution), cmap, vmin=vmin, vmax=vmax, origin=origin)
+    if filename.endswith(".png"):
+        WritePNG(filename, rgba)
+    else:
+        from PIL import Image
+        Image.fromarray(rgba, mode="RGBA").save(filename)
+
+
 class KittiePlotter(object):
     
     def __init__(self, comm, on=False):
@@ -70,7 +164,12 @@ class KittiePlotter(object):
             only += [self.DimInfo['xname']]
 
         size = self._InitByCommSize()
-        index = 0
+        types = {}
+
+        # Cost is bytes read, scaled by any weights set for the plots.
+        # Everything matched has x's shape, so without weights this only tells types apart, and the split is about round-robin.
+        weights = self.config[self.gname].get('weights', {})
+        self.DimInfo['Costs'] = {}
 
         for name in only:
             if (name in exclude) or ((name == self.DimInfo['xname']) and xomit):
@@ -79,11 +178,14 @@ class KittiePlotter(object):
             varid = self.io.InquireVariable(name)
             TestShape = varid.Shape()
             if shape == TestShape:
-                i = index % size
-                self.DimInfo['UserMatches'][i] += [name]
-                dtype = kittie_common.GetType(varid)
-                self.DimInfo['UserTypes'][i] += [dtype]
-                index += 1
+                types[name] = kittie_common.GetType(varid)
+                nbytes = np.prod(shape) * np.dtype(types[name]).itemsize
+                self.DimInfo['Costs'][name] = float(nbytes) * weights.get(name, 1.0)
+
+        parts = Partition(self.DimInfo['Costs'], size)
+        for i in range(size):
+            self.DimInfo['UserMatches'][i] = parts[i]
+            self.DimInfo['UserTypes'][i] = [types[name] for name in parts[i]]
 
         return shape
 
@@ -137,13 +239,13 @@ class KittiePlotter(object):
         return xstart, xcount, xname, xtype, ystart, ycount, yname, ytype
 
 
-    def _GetSelections(self, xaxis, exclude=[], only=[], xomit=False):
+    def _GetSelections(self, xaxis, exclude=[], only=[], xomit=False, allx=True):
 
         # Get the name and slice
         xsel = self._xParse(xaxis)
 
-        # Get the full shape and other variables that match it
-        xShape = self._GetMatching(exclude=exclude, only=only, xomit=False)
+        # Get the full shape and other variables that match it. With allx every rank reads x anyway, so it isn't split up with the rest
+        xShape = self._GetMatching(exclude=exclude, only=only, xomit=allx)
 
         # Get ADIOS selections
         starts, counts = ShapeParse(xShape, xsel)
@@ -152,8 +254,9 @@ class KittiePlotter(object):
 
 
     def _SetupArrays(self, allx, explicit=False):
-        self.uMatches = self.DimInfo['UserMatches']
-        self.uTypes = self.DimInfo['UserTypes']
+        self.allx = allx
+        self.uMatches = list(self.DimInfo['UserMatches'])
+        self.uTypes = list(self.DimInfo['UserTypes'])
         if allx:
             self.uMatches += [self.DimInfo['xname']]
             self.uTypes += [self.DimInfo['xType']]
@@ -228,9 +331,10 @@ class KittiePlotter(object):
             return False
 
 
-    def GetMatchingSelections(self, adios, xaxis, exclude=[], only=[], xomit=False, allx=True, y="match-dimensions"):
+    def GetMatchingSelections(self, adios, xaxis, exclude=[], only=[], xomit=False, allx=True, y="match-dimensions", minmax=False):
+        self.y = y
         self.DimInfo = {}
-        for name in ["xname", "xType", "UserMatches", "UserTypes"]:
+        for name in ["xname", "xType", "UserMatches", "UserTypes", "Costs"]:
             self.DimInfo[name] = None
         if y == "match-dimensions":
             explicit = False
@@ -246,7 +350,7 @@ class KittiePlotter(object):
             self.engine.BeginStep(kittie.Kittie.ReadStepMode, -1.0)
             self.io = kittie.Kittie.adios.AtIO(self.gname)
             if y == "match-dimensions":
-                self._GetSelections(xaxis, exclude=exclude, only=only, xomit=xomit)
+                self._GetSelections(xaxis, exclude=exclude, only=only, xomit=xomit, allx=allx)
             else:
                 xstart, xcount, xname, xtype, ystart, ycount, yname, ytype = self._GetExplicit(xaxis, y)
 
@@ -258,7 +362,7 @@ class KittiePlotter(object):
         if y == "match-dimensions":
             for name in ['starts', 'counts']:
                 self.DimInfo[name] = self.comm.bcast(self.DimInfo[name], root=0)
-        for name in ['xname', 'xType']:
+        for name in ['xname', 'xType', 'Costs']:
             self.DimInfo[name] = self.comm.bcast(self.DimInfo[name], root=0)
         for name in ['UserMatches', 'UserTypes']:
             self.DimInfo[name] = self.comm.scatter(self.DimInfo[name], root=0)
@@ -272,6 +376,43 @@ class KittiePlotter(object):
             color = 1
         self.ReadComm = self.comm.Split(color, self.rank)
 
+        # rebalance: every that many steps, re-split the variables by how long they've actually been taking to plot
+        self.rebalance = 0
+        if not explicit:
+            self.rebalance = int(self.config[self.gname].get('rebalance', 0))
+        self.RenderTimes = {}
+        self.RenderSteps = 0
+
+        # pipeline: read up to that many steps ahead in a thread, while the current one plots.
+        # The thread's ADIOS calls are collective over ReadComm, so the main thread's barriers go over a copy of it.
+        # Both threads calling MPI at once needs MPI_THREAD_MULTIPLE; without it, read synchronously.
+        self.pipeline = int(self.config[self.gname].get('pipeline', 0))
+        if (self.pipeline > 0) and (not kittie.ThreadMultiple(self.ReadComm)):
+            warnings.warn("MPI isn't initialized with MPI_THREAD_MULTIPLE, ignoring pipeline for {0}".format(self.gname))
+            self.pipeline = 0
+        self.reader = None
+        self.MainComm = self.ReadComm
+        if self.pipeline > 0:
+            self.MainComm = self.ReadComm.Dup()
+            self.rebalance = 0
+        self.waiter = kittie.WaitStrategy(self.config[self.gname].get('wait', None))
+
+        # latest: when falling behind, skip ahead to the newest step that's been written; stride: plot no more often than every that many steps
+        self.latest = bool(self.config[self.gname].get('latest', False))
+        self.stride = max(int(self.config[self.gname].get('stride', 1)), 1)
+        self.StepsSeen = 0
+        self.LastRendered = None
+        self.SkipTarget = -1
+        self.index = None
+
+        # colorscale: global keeps each variable's colors fixed over time, by its min/max over every step so far (global-symmetric: about zero).
+        # data['minmax'] is only filled for plotters that ask for it every step (minmax), or when colorscale needs it
+        self.colorscale = str(self.config[self.gname].get('colorscale', 'step')).lower()
+        if self.colorscale not in ['step', 'global', 'global-symmetric']:
+            raise ValueError("Unknown colorscale for {0}: {1}".format(self.gname, self.colorscale))
+        self.minmax = bool(minmax) or (self.colorscale != 'step')
+        self.GlobalMinMax = {}
+
         if self.Active:
             self._SetupArrays(allx, explicit=explicit)
             if explicit:
@@ -319,6 +460,146 @@ class KittiePlotter(object):
 
 
 
+    def _IndexFile(self):
+        """ The plotter's file, if it's BP4 and so has an md.idx that grows with each step """
+        settings = kittie.Kittie.YamlEngineSettings.get("plotter", {})
+        engine = settings.get('engine', 'BP4')
+        if isinstance(engine, dict):
+            engine = engine.get('name', 'BP4')
+        if str(engine).lower() in kittie.Kittie.IndexMethods:
+            return kittie.Kittie.Couplers["plotter"].filename
+        return None
+
+
+    def _WaitStep(self, waiter):
+        """
+        Block in BeginStep for up to the waiter's interval. Engines that come back NotReady well before that get slept on instead
+        (woken early by md.idx changing, with inotify), and the interval backs off while nothing's new, so waiting doesn't spin.
+        """
+        start = time.time()
+        ReadStatus = self._BeginStep(waiter.interval)
+
+        if ReadStatus == adios2.StepStatus.NotReady:
+            if (time.time() - start) < 0.5 * waiter.interval:
+                filename = self._IndexFile()
+                if filename is not None:
+                    waiter.Watch(os.path.join(filename, 'md.idx'))
+                waiter.Sleep()
+            else:
+                waiter.Backoff()
+        else:
+            waiter.Reset()
+
+        return ReadStatus
+
+
+    def _Skip(self, step):
+        """ Rank 0 decides for everyone; how far the file's been written is only known for BP4 files, from md.idx """
+        skip = False
+        if self.ReadComm.Get_rank() == 0:
+            if self.latest and (self.index is None):
+                filename = self._IndexFile()
+                if filename is not None:
+                    self.index = kittie.MetaIndex(filename)
+                else:
+                    self.index = False
+
+            # SkipTarget is the newest step written when md.idx was last read: draw it when it comes up, and only look again once past it
+            if self.index and (step > self.SkipTarget):
+                self.SkipTarget = self.index.Refresh() - 1
+            skip = (step < self.SkipTarget)
+            if (self.LastRendered is not None) and (step - self.LastRendered < self.stride):
+                skip = True
+        skip = self.ReadComm.bcast(skip, root=0)
+
+        if not skip:
+            self.LastRendered = step
+        return skip
+
+
+    def _BeginStep(self, timeout):
+        """ Steps that are skipped are ended without reading anything """
+        while True:
+            #@effis-begin self.engine--->"plotter"
+            ReadStatus = self.engine.BeginStep(kittie.Kittie.ReadStepMode, timeout)
+            #@effis-end
+
+            if (ReadStatus != adios2.StepStatus.OK) or ((not self.latest) and (self.stride == 1)):
+                return ReadStatus
+            self.StepsSeen += 1
+            if not self._Skip(self.StepsSeen - 1):
+                return ReadStatus
+
+            #@effis-begin self.engine--->"plotter"
+            self.engine.EndStep()
+            #@effis-end
+
+
+    def _StartReader(self):
+        """ Buffer sets share whatever else is in data (like a mesh), and have their own arrays for what's read each step """
+        self.free = queue.Queue()
+        self.ready = queue.Queue()
+        for i in range(self.pipeline + 1):
+            data = dict(self.data)
+            for name in self.uMatches + ['_StepPhysical', '_StepNumber']:
+                data[name] = np.zeros_like(self.data[name])
+            data['minmax'] = {}
+            self.free.put(data)
+        self.ReadWaiter = kittie.WaitStrategy(self.config[self.gname].get('wait', None))
+        self.reader = threading.Thread(target=self._ReadAhead, name="kittie-plot-reader")
+        self.reader.daemon = True
+        self.reader.start()
+
+
+    def _ReadAhead(self):
+        try:
+            while True:
+                data = self.free.get()
+
+                while True:
+                    ReadStatus = self._WaitStep(self.ReadWaiter)
+                    if ReadStatus != adios2.StepStatus.NotReady:
+                        break
+
+                if ReadStatus != adios2.StepStatus.OK:
+                    self.ready.put(ReadStatus)
+                    break
+
+                self._ScheduleReads(y=self.y, data=data)
+                #@effis-begin self.engine--->"plotter"
+                self.engine.EndStep()
+                #@effis-end
+                self._MinMax(data)
+                self.ready.put(data)
+
+        except Exception as e:
+            self.ready.put(e)
+
+
+    def _NextStatus(self):
+        if self.pipeline <= 0:
+            ReadStatus = self._WaitStep(self.waiter)
+            if ReadStatus != adios2.StepStatus.NotReady:
+                print(ReadStatus); sys.stdout.flush()
+            return ReadStatus
+
+        # Wait on the reader thread the way _WaitStep waits on the engine, backing off while nothing's come
+        if self.reader is None:
+            self._StartReader()
+        try:
+            data = self.ready.get(timeout=self.waiter.interval)
+        except queue.Empty:
+            self.waiter.Backoff()
+            return adios2.StepStatus.NotReady
+        self.waiter.Reset()
+        if isinstance(data, Exception):
+            raise data
+        elif isinstance(data, dict):
+            self.data = data
+            return adios2.StepStatus.OK
+        return data
+
+
     @property
     def NotDone(self):
         NewStep = False
@@ -326,10 +607,7 @@ class KittiePlotter(object):
         if self.on and (self.rank == 0) and (not self.SteppingDone):
             NewStep = self._CheckStepFile()
 
-        #@effis-begin self.engine--->"plotter"
-        ReadStatus = self.engine.BeginStep(kittie.Kittie.ReadStepMode, 0.0)
-        print(ReadStatus); sys.stdout.flush()
-        #@effis-end
+        ReadStatus = self._NextStatus()
 
         self.DoPlot = True
 
@@ -345,8 +623,7 @@ class KittiePlotter(object):
         elif ReadStatus != adios2.StepStatus.OK:
             if (self.rank == 0) and self.on:
                 print(self.LastStepFile); sys.stdout.flush()
-                while not os.path.exists(self.LastStepFile):
-                    continue
+                self.waiter.Until(lambda: os.path.exists(self.LastStepFile), path=self.LastStepFile)
                 print("found", self.LastStepFile); sys.stdout.flush()
                 with open(self.LastStepFile, 'r') as infile:
                     text = infile.read()
@@ -369,39 +646,64 @@ class KittiePlotter(object):
         return True
 
 
-    def _ScheduleReads(self, y="match-dimensions"):
-        self.data['minmax'] = {}
-        for name in ['_StepPhysical', '_StepNumber']:
-            varid = self.io.InquireVariable(name)
-            self.engine.Get(varid, self.data[name])
+    def _Variable(self, name):
+        # The coupler caches the handles, and forgets them when it closes the file (or every step, for streaming engines)
+        return kittie.Kittie.Couplers["plotter"].Variable(name)
 
-        variables = self.io.AvailableVariables()
+
+    def _ScheduleReads(self, y="match-dimensions", data=None):
+        if data is None:
+            data = self.data
+        data['minmax'] = {}
+        for name in ['_StepPhysical', '_StepNumber']:
+            self.engine.Get(self._Variable(name), data[name])
 
         if y == "match-dimensions":
-            for name in self.uMatches:
-                varid = self.io.InquireVariable(name)
-                varid.SetSelection([self.DimInfo['starts'], self.DimInfo['counts']])
-                self.engine.Get(varid, self.data[name])
-                self.data['minmax'][name] = {}
-                self.data['minmax'][name]['min'] = float(variables[name]['Min'])
-                self.data['minmax'][name]['max'] = float(variables[name]['Max'])
+            starts = [self.DimInfo['starts']] * len(self.uMatches)
+            counts = [self.DimInfo['counts']] * len(self.uMatches)
         else:
-            for name, start, count in zip(self.uMatches, self.uStarts, self.uCounts):
-                varid = self.io.InquireVariable(name)
-                varid.SetSelection([start, count])
-                self.engine.Get(varid, self.data[name])
-                self.data['minmax'][name] = {}
-                self.data['minmax'][name]['min'] = float(variables[name]['Min'])
-                self.data['minmax'][name]['max'] = float(variables[name]['Max'])
+            starts = self.uStarts
+            counts = self.uCounts
+
+        for name, start, count in zip(self.uMatches, starts, counts):
+            varid = self._Variable(name)
+            varid.SetSelection([start, count])
+            self.engine.Get(varid, data[name])
+
+
+    def _MinMax(self, data):
+        """
+        min/max of what was read (the plotted selection, not the whole variable, which needed every variable's metadata each step),
+        and the running min/max over all steps (used instead with colorscale global). Only done for plotters that use it,
+        and not for an x-axis every rank reads (allx), which is never drawn in color.
+        """
+        if not self.minmax:
+            return
+        for name in self.uMatches:
+            if self.allx and (name == self.DimInfo['xname']):
+                continue
+            data['minmax'][name] = {'min': float(np.nanmin(data[name])), 'max': float(np.nanmax(data[name]))}
+
+            if name not in self.GlobalMinMax:
+                self.GlobalMinMax[name] = dict(data['minmax'][name])
+            else:
+                self.GlobalMinMax[name]['min'] = min(self.GlobalMinMax[name]['min'], data['minmax'][name]['min'])
+                self.GlobalMinMax[name]['max'] = max(self.GlobalMinMax[name]['max'], data['minmax'][name]['max'])
+
+            if self.colorscale != "step":
+                data['minmax'][name] = dict(self.GlobalMinMax[name])
 
 
     def GetPlotData(self, y="match-dimensions"):
 
-        self._ScheduleReads(y=y)
+        # When pipelined, the reader thread already has the step in data
+        if self.pipeline <= 0:
+            self._ScheduleReads(y=y)
 
-        #@effis-begin self.engine--->"plotter"
-        self.engine.EndStep()
-        #@effis-end
+            #@effis-begin self.engine--->"plotter"
+            self.engine.EndStep()
+            #@effis-end
+            self._MinMax(self.data)
 
         #self.outdir = os.path.join("images", "{1}-{0}".format(self.data['_StepNumber'][0], self.config['plotter']['plots']))
         self.outdir = os.path.join("images", str(self.data['_StepNumber'][0]), self.config['plotter']['plots'])
@@ -409,13 +711,75 @@ class KittiePlotter(object):
             if not os.path.exists(self.outdir):
                 os.makedirs(self.outdir)
 
-        self.ReadComm.Barrier()
-        self.LastFoundData = self.data['_StepNumber']
+        self.MainComm.Barrier()
+
+        # A copy, since the array goes back to the reader to be refilled
+        self.LastFoundData = np.array(self.data['_StepNumber'])
         #LastFoundStep[0] = LastFoundData[0]
+        self.RenderStart = time.time()
+
+
+    def _Owned(self):
+        """ This rank's share of the split: its matches, less x when every rank reads it (allx) """
+        own = []
+        for name in self.uMatches:
+            if self.allx and (name == self.DimInfo['xname']):
+                continue
+            if (name in self.DimInfo['Costs']) and (name not in own):
+                own += [name]
+        return own
+
+
+    def _Rebalance(self):
+        """
+        The plotters draw all of a rank's variables in one call, so each rank's time is split over its variables by their share of its bytes.
+        Then the variables are partitioned again from those times, over the ranks that read.
+        """
+        own = self._Owned()
+        types = dict([(name, dtype) for name, dtype in zip(self.uMatches, self.uTypes)])
+        measured = dict([(name, self.RenderTimes.get(name, 0.0) / max(self.RenderSteps, 1)) for name in own])
+
+        allmeasured = self.ReadComm.gather(measured, root=0)
+        alltypes = self.ReadComm.gather(dict([(name, types[name]) for name in own]), root=0)
+        parts = None
+        if self.ReadComm.Get_rank() == 0:
+            costs = {}
+            for entry in allmeasured:
+                costs.update(entry)
+            for entry in alltypes:
+                types.update(entry)
+            parts = Partition(costs, self.ReadComm.Get_size())
+            parts = [[(name, types[name]) for name in part] for part in parts]
+        part = self.ReadComm.scatter(parts, root=0)
+
+        # x (with allx) was never part of the split, so its array stays
+        names = [entry[0] for entry in part]
+        for name in own:
+            if name not in names:
+                del self.data[name]
+        self.uMatches = names
+        self.uTypes = [entry[1] for entry in part]
+        for name, dtype in part:
+            if name not in self.data:
+                self.data[name] = np.zeros(tuple(self.DimInfo['counts']), dtype=dtype)
+        if self.allx:
+            self.uMatches += [self.DimInfo['xname']]
+            self.uTypes += [self.DimInfo['xType']]
+
+        self.RenderTimes = {}
+        self.RenderSteps = 0
 
 
     def StepDone(self):
-        self.ReadComm.Barrier()
+        if self.rebalance > 0:
+            elapsed = time.time() - self.RenderStart
+            own = self._Owned()
+            total = sum([self.DimInfo['Costs'][name] for name in own])
+            for name in own:
+                self.RenderTimes[name] = self.RenderTimes.get(name, 0.0) + elapsed * self.DimInfo['Costs'][name] / max(total, 1e-300)
+            self.RenderSteps += 1
+
+        self.MainComm.Barrier()
         if self.on and (self.rank == 0):
             #@effis-begin self.DoneEngine--->"done"
             self.DoneEngine.BeginStep()
@@ -423,4 +787,10 @@ class KittiePlotter(object):
             self.DoneEngine.EndStep()
             #@effis-end
 
+        if (self.rebalance > 0) and (self.RenderSteps >= self.rebalance):
+            self._Rebalance()
+
+        if self.reader is not None:
+            self.free.put(self.data)
+
 
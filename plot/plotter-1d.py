@@ -17,7 +17,13 @@ import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
 
 
-def Plot(data, xname, outdir, fs=20):
+inits = {}
+fig = {}
+ax = {}
+line = {}
+
+
+def Plot(data, xname, outdir, fs=20, ext="svg"):
 
     for name in data.keys():
         if name in ['_StepPhysical', '_StepNumber', xname, 'minmax']:
@@ -25,17 +31,23 @@ def Plot(data, xname, outdir, fs=20):
 
         print(xname, name, data['_StepNumber'], data['_StepPhysical']); sys.stdout.flush()
 
-        gs = gridspec.GridSpec(1, 1)
-        fig = plt.figure(figsize=(7,6))
-        ax = fig.add_subplot(gs[0, 0])
+        # Figures stay around between steps, and just get new data
+        if name not in inits:
+            gs = gridspec.GridSpec(1, 1)
+            fig[name] = plt.figure(figsize=(7,6))
+            ax[name] = fig[name].add_subplot(gs[0, 0])
+            line[name], = ax[name].plot(data[xname].flatten(), data[name].flatten())
+            ax[name].set_xlabel(xname, fontsize=fs)
+            ax[name].set_ylabel(name,  fontsize=fs)
+            inits[name] = True
+        else:
+            line[name].set_data(data[xname].flatten(), data[name].flatten())
+            ax[name].relim()
+            ax[name].autoscale_view()
 
-        ax.plot(data[xname].flatten(), data[name].flatten())
-        ax.set_xlabel(xname, fontsize=fs)
-        ax.set_ylabel(name,  fontsize=fs)
-        ax.set_title("{1},  time = {0:.1e}".format(data['_StepPhysical'][0], name),  fontsize=fs)
+        ax[name].set_title("{1},  time = {0:.1e}".format(data['_StepPhysical'][0], name),  fontsize=fs)
 
-        fig.savefig(os.path.join(outdir, "{0}_vs_{1}-{2}.svg".format(name.replace('/', '|'), xname.replace('/', '|'), data['_StepNumber'][0])), bbox_inches="tight")
-        plt.close(fig)
+        fig[name].savefig(os.path.join(outdir, "{0}_vs_{1}-{2}.{3}".format(name.replace('/', '|'), xname.replace('/', '|'), data['_StepNumber'][0], ext)), bbox_inches="tight")
 
 
 def ParseArgs():
@@ -45,6 +57,7 @@ def ParseArgs():
     parser.add_argument("-o", "--only",     help="Only plot the given y-values", type=str, default=[])
     parser.add_argument("-e", "--exclude", help="Don't plot the given y-values", type=str, default=[])
     parser.add_argument("-y", "--y", help="How to generate Y-value(s)", type=str, default="match-dimensions")
+    parser.add_argument("-x", "--ext", help="Image extension", type=str, default="svg", choices=["svg", "png", "webp"])
     parser.add_argument("-d", "--use-dashboard", help="Using dashboard", type=str, default="off")
     args = parser.parse_args()
 
@@ -79,7 +92,7 @@ if __name__ == "__main__":
 
             if plotter.DoPlot:
                 plotter.GetPlotData(y=args.y)
-                Plot(plotter.data, plotter.DimInfo['xname'], plotter.outdir)
+                Plot(plotter.data, plotter.DimInfo['xname'], plotter.outdir, ext=args.ext)
                 plotter.StepDone()
 
     #@effis-finalize
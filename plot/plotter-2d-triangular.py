@@ -21,18 +21,63 @@ import matplotlib.tri as tri
 from matplotlib.ticker import FormatStrFormatter
 
 
-def Plot(data, nodesname, triname, outdir, fs=20, xname="x", yname="y", cmap="bwr", nlevels=40, minmax=False):
+inits = {}
+fig = {}
+ax = {}
+ColorAxis = {}
+ColorBar = {}
 
+
+def RemoveContours(contours):
+    # Newer matplotlib removes a ContourSet as one artist; older ones need each collection taken out
+    try:
+        contours.remove()
+    except (AttributeError, NotImplementedError, ValueError):
+        for collection in contours.collections:
+            collection.remove()
+
+
+def Triangulate(nodes, triangles, decimate=1):
+    """
+    Build the triangulation once, to share over every variable and step.
+    With decimate > 1, render with every decimate-th node instead, re-triangulated, with the triangles that fall outside the real mesh masked off.
+    Returns the triangulation, and which nodes of the data go with it.
+    """
+
+    triang = tri.Triangulation(nodes[:, 0], nodes[:, 1], triangles=triangles)
+    if decimate <= 1:
+        return triang, slice(None)
+
+    keep = slice(None, None, decimate)
+    coarse = tri.Triangulation(nodes[keep, 0], nodes[keep, 1])
+    x = np.mean(coarse.x[coarse.triangles], axis=1)
+    y = np.mean(coarse.y[coarse.triangles], axis=1)
+    coarse.set_mask(triang.get_trifinder()(x, y) == -1)
+    return coarse, keep
+
+
+def Plot(data, nodesname, triname, outdir, fs=20, xname="x", yname="y", cmap="bwr", nlevels=40, minmax=False, triang=None, keep=slice(None), ext="svg"):
+
+    if triang is None:
+        triang = tri.Triangulation(data[nodesname][:, 0], data[nodesname][:, 1], triangles=data[triname])
     levels = nlevels
+    unit = np.linspace(-1, 1, levels)
+
     for name in data.keys():
         if name in ['_StepPhysical', '_StepNumber', nodesname, triname, 'minmax']:
             continue
 
         print(name, data['_StepNumber'], data['_StepPhysical']); sys.stdout.flush()
 
-        gs = gridspec.GridSpec(1, 1)
-        fig = plt.figure(figsize=(7,6))
-        ax = fig.add_subplot(gs[0, 0])
+        # The figure and axes are made once; each step swaps out the filled contours, and redraws the colorbar in its same axes
+        if name not in inits:
+            gs = gridspec.GridSpec(1, 1)
+            fig[name] = plt.figure(figsize=(7,6))
+            ax[name] = fig[name].add_subplot(gs[0, 0])
+            ax[name].set_xlabel(xname, fontsize=fs)
+            ax[name].set_ylabel(yname, fontsize=fs)
+        else:
+            RemoveContours(ColorAxis[name])
 
         kwargs = {}
         kwargs['cmap'] = plt.get_cmap(cmap)
@@ -40,22 +85,26 @@ def Plot(data, nodesname, triname, outdir, fs=20, xname="x", yname="y", cmap="bw
             opt = np.amax(np.fabs([data['minmax'][name]['min'], data['minmax'][name]['max']])) + 1e-20
             kwargs['vmin'] = -opt
             kwargs['vmax'] = opt
-            nlevels = np.linspace(-opt, opt, levels)
-
-        triang = tri.Triangulation(data[nodesname][:, 0], data[nodesname][:, 1], triangles=data[triname])
-        ColorAxis = ax.tricontourf(triang, data[name].flatten(), nlevels, **kwargs)
-        ColorBar = fig.colorbar(ColorAxis, ax=ax, format="%+.2e")
-        ColorBar.set_label(name, fontsize=fs)
+            nlevels = unit * opt
+
+        ColorAxis[name] = ax[name].tricontourf(triang, data[name].flatten()[keep], nlevels, **kwargs)
+
+        # update_normal keeps the first step's boundaries when the levels change, so the colorbar's rebuilt every step
+        if name not in inits:
+            ColorBar[name] = fig[name].colorbar(ColorAxis[name], ax=ax[name], format="%+.2e")
+            inits[name] = True
+        else:
+            cax = ColorBar[name].ax
+            cax.clear()
+            ColorBar[name] = fig[name].colorbar(ColorAxis[name], cax=cax, format="%+.2e")
+        ColorBar[name].set_label(name, fontsize=fs)
         if minmax:
             ticks = np.linspace(-opt, opt, 7)
-            ColorBar.set_ticks(ticks)
+            ColorBar[name].set_ticks(ticks)
 
-        ax.set_xlabel(xname, fontsize=fs)
-        ax.set_ylabel(yname, fontsize=fs)
-        ax.set_title("{1},  time = {0:.1e}".format(data['_StepPhysical'][0], name),  fontsize=fs)
+        ax[name].set_title("{1},  time = {0:.1e}".format(data['_StepPhysical'][0], name),  fontsize=fs)
 
-        fig.savefig(os.path.join(outdir, "{0}_vs_{2}_{3}-{1}.svg".format(name, data['_StepNumber'][0], xname, yname)), bbox_inches="tight")
-        plt.close(fig)
+        fig[name].savefig(os.path.join(outdir, "{0}_vs_{2}_{3}-{1}.{4}".format(name, data['_StepNumber'][0], xname, yname, ext)), bbox_inches="tight")
 
 
 def ReadMesh(nodesname, triname, griddata={}):
@@ -95,6 +144,8 @@ def ParseArgs():
     parser.add_argument("-e", "--exclude",  help="Don't plot the given y-values", type=str, default=[])
     parser.add_argument("-c", "--colormap", help="Colormap to use", type=str, default="bwr")
     parser.add_argument("-n", "--nlevels",  help="Number of color levels", type=int, default=40)
+    parser.add_argument("-D", "--decimate", help="Render with every Nth mesh node, for big meshes", type=int, default=1)
+    parser.add_argument("-x", "--ext", help="Image extension", type=str, default="svg", choices=["svg", "png", "webp"])
     parser.add_argument("-d", "--use-dashboard", help="Using dashboard", type=str, default="off")
     args = parser.parse_args()
 
@@ -121,11 +172,12 @@ if __name__ == "__main__":
     adios = adios2.ADIOS(comm)
     plotter = plot_util.KittiePlotter(comm, on=args.use_dashboard)
     plotter.ConnectToStepInfo(adios, group="plotter")
-    plotter.GetMatchingSelections(adios, args.gridvar, exclude=args.exclude, only=args.only, xomit=False, allx=False)
+    plotter.GetMatchingSelections(adios, args.gridvar, exclude=args.exclude, only=args.only, xomit=False, allx=False, minmax=True)
 
     print('C'); sys.stdout.flush()
     plotter.data = ReadMesh(args.nodes, args.triangles, griddata=plotter.data)
     print('D'); sys.stdout.flush()
+    triang, keep = Triangulate(plotter.data[args.nodes], plotter.data[args.triangles], decimate=args.decimate)
 
     if plotter.Active:
 
@@ -133,7 +185,7 @@ if __name__ == "__main__":
 
             if plotter.DoPlot:
                 plotter.GetPlotData()
-                Plot(plotter.data, args.nodes, args.triangles, plotter.outdir, xname="r", yname="z", cmap=args.colormap, nlevels=args.nlevels, minmax=True)
+                Plot(plotter.data, args.nodes, args.triangles, plotter.outdir, xname="r", yname="z", cmap=args.colormap, nlevels=args.nlevels, minmax=True, triang=triang, keep=keep, ext=args.ext)
                 plotter.StepDone()
 
     #@effis-finalize
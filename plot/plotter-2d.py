@@ -27,13 +27,32 @@ ColorAxis = {}
 ColorBar = {}
 
 
-def Plot(data, outdir, fs=20, xname="x", yname="y", cmap="bwr", minmax=False, interactive="image", ext="svg"):
+def Limits(limits, symmetric=False):
+    """ Color limits from a {'min', 'max'}: as they are, or symmetric about zero out to the larger magnitude """
+    if symmetric:
+        opt = np.amax(np.fabs([limits['min'], limits['max']])) + 1e-20
+        return -opt, opt
+    return limits['min'], max(limits['max'], np.nextafter(limits['min'], np.inf))
+
+
+def Plot(data, outdir, fs=20, xname="x", yname="y", cmap="bwr", minmax=False, symmetric=False, interactive="image", ext="svg", raster=False, resolution=0):
 
     for name in data.keys():
         if name in ['_StepPhysical', '_StepNumber', 'minmax']:
             continue
         print(name, data['_StepNumber'], data['_StepPhysical']); sys.stdout.flush()
 
+        # Raster files come straight from the array; a figure is only needed if it's also being shown
+        if raster and (interactive != "interactive"):
+            vmin = None
+            vmax = None
+            if minmax:
+                vmin, vmax = Limits(data['minmax'][name], symmetric=symmetric)
+            filename = os.path.join(outdir, "{0}_vs_{2}_{3}-{1}.{4}".format(name.replace('/', '|'), data['_StepNumber'][0], xname, yname, ext))
+            plot_util.WriteRaster(filename, data[name].squeeze(), cmap, vmin=vmin, vmax=vmax, resolution=resolution)
+            if interactive == "image":
+                continue
+
         if name not in inits:
             inits[name] = False
 
@@ -45,9 +64,7 @@ def Plot(data, outdir, fs=20, xname="x", yname="y", cmap="bwr", minmax=False, in
             kwargs[name]['cmap'] = plt.get_cmap(cmap)
             kwargs[name]['origin'] = "lower"
         if minmax:
-            opt = np.amax(np.fabs([data['minmax'][name]['min'], data['minmax'][name]['max']])) + 1e-20
-            kwargs[name]['vmin'] = -opt
-            kwargs[name]['vmax'] = opt
+            kwargs[name]['vmin'], kwargs[name]['vmax'] = Limits(data['minmax'][name], symmetric=symmetric)
 
         if not inits[name]:
             ColorAxis[name] = ax[name].imshow(data[name].squeeze(), **(kwargs[name]))
@@ -64,7 +81,7 @@ def Plot(data, outdir, fs=20, xname="x", yname="y", cmap="bwr", minmax=False, in
 
         ax[name].set_title("{1},  time = {0:.1e}".format(data['_StepPhysical'][0], name),  fontsize=fs)
         if minmax:
-            ticks = np.linspace(-opt, opt, 7)
+            ticks = np.linspace(kwargs[name]['vmin'], kwargs[name]['vmax'], 7)
             ColorBar[name].set_ticks(ticks)
 
         if not inits[name]:
@@ -75,7 +92,7 @@ def Plot(data, outdir, fs=20, xname="x", yname="y", cmap="bwr", minmax=False, in
                 fig[name].canvas.draw()
                 fig[name].canvas.flush_events()
 
-        if interactive != "interactive":
+        if (interactive != "interactive") and (not raster):
             fig[name].savefig(os.path.join(outdir, "{0}_vs_{2}_{3}-{1}.{4}".format(name.replace('/', '|'), data['_StepNumber'][0], xname, yname, ext)), bbox_inches="tight")
 
         #plt.close(fig)
@@ -91,7 +108,9 @@ def ParseArgs():
     parser.add_argument("-e", "--exclude",  help="Don't plot the given y-values", type=str, default=[])
     parser.add_argument("-c", "--colormap", help="Colormap to use", type=str, default="bwr")
     parser.add_argument("-t", "--type", help="Image file and/or interactive", type=str, default="image", choices=["image", "interactive", "both"])
-    parser.add_argument("-x", "--ext", help="Image extension", type=str, default="svg", choices=["svg", "png"])
+    parser.add_argument("-x", "--ext", help="Image extension", type=str, default="svg", choices=["svg", "png", "webp"])
+    parser.add_argument("-r", "--raster", help="Write images straight from the data, without matplotlib (png or webp)", type=str, default="off")
+    parser.add_argument("-R", "--resolution", help="Downsample raster images to at most this many pixels on a side (0 for full size)", type=int, default=0)
     parser.add_argument("-d", "--use-dashboard", help="Using dashboard", type=str, default="off")
 
     args = parser.parse_args()
@@ -106,6 +125,10 @@ def ParseArgs():
     else:
         args.use_dashboard = False
 
+    args.raster = (str(args.raster).lower() in ["on", "yes", "true"])
+    if args.raster and (args.ext == "svg"):
+        args.ext = "png"
+
     return args
 
 
@@ -118,7 +141,7 @@ if __name__ == "__main__":
     adios = adios2.ADIOS(comm)
     plotter = plot_util.KittiePlotter(comm, on=args.use_dashboard)
     plotter.ConnectToStepInfo(adios, group="plotter")
-    plotter.GetMatchingSelections(adios, args.gridvar, exclude=args.exclude, only=args.only, xomit=False, allx=False)
+    plotter.GetMatchingSelections(adios, args.gridvar, exclude=args.exclude, only=args.only, xomit=False, allx=False, minmax=False)
 
 
     if plotter.Active:
@@ -129,7 +152,7 @@ if __name__ == "__main__":
 
             if plotter.DoPlot:
                 plotter.GetPlotData()
-                Plot(plotter.data, plotter.outdir, xname="x", yname="y", cmap=args.colormap, minmax=False, interactive=args.type, ext=args.ext)
+                Plot(plotter.data, plotter.outdir, xname="x", yname="y", cmap=args.colormap, minmax=plotter.minmax, symmetric=(plotter.colorscale == "global-symmetric"), interactive=args.type, ext=args.ext, raster=args.raster, resolution=args.resolution)
                 plotter.StepDone()
 
     #@effis-finalize
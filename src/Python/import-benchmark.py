@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+# Let's keep everything tested with python 2 and python 3
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+"""
+Regression check for how long `import kittie` takes. Fails (exit 1) if any of the heavy modules
+get imported eagerly, or if the import costs more than the budget over a bare interpreter start.
+"""
+
+import argparse
+import subprocess
+import sys
+import time
+
+
+heavy = ["adios2", "numpy", "yaml", "mpi4py", "multiprocessing"]
+
+
+def Best(code, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        subprocess.check_call([sys.executable, "-c", code])
+        elapsed = time.time() - start
+        if (best is None) or (elapsed < best):
+            best = elapsed
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-b", "--budget", help="Allowed import time (seconds) over a bare interpreter start", type=float, default=0.05)
+    parser.add_argument("-r", "--repeat", help="Number of runs to take the best of", type=int, default=7)
+    args = parser.parse_args()
+
+    check = "import sys, kittie; print(' '.join([name for name in {0} if name in sys.modules]))".format(heavy)
+    loaded = subprocess.check_output([sys.executable, "-c", check]).decode('utf-8').split()
+
+    base = Best("pass", args.repeat)
+    total = Best("import kittie", args.repeat)
+    cost = total - base
+    print("import kittie: {0:.3f} s ({1:.3f} s over bare python, budget {2:.3f} s)".format(total, cost, args.budget))
+
+    failed = False
+    if len(loaded) > 0:
+        print("Imported eagerly: {0}".format(', '.join(loaded)))
+        failed = True
+    if cost > args.budget:
+        print("Over budget")
+        failed = True
+
+    if failed:
+        sys.exit(1)
@@ -1,3 +1,5 @@
 #from kittie import *
 from kittie.kittie import *
 import kittie.kittie_common as kittie_common
+from kittie.kittie_timing import TimingRead
+import kittie.kittie_timing as kittie_timing
@@ -3,18 +3,561 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import sys
-import adios2
-
-import datetime
 import time
 import os
-import copy
-import numpy as np
-import yaml
-import subprocess
-import yaml
-import numpy as np
 import warnings
+import select
+import threading
+import contextlib
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from kittie.kittie_common import LazyModule, GetType, BufferPool
+
+# These are slow to import, so wait until something actually uses them
+adios2 = LazyModule("adios2")
+np = LazyModule("numpy")
+yaml = LazyModule("yaml")
+
+
+class PollWait(object):
+    """
+    Sleep between checks, growing the interval geometrically from initial up to ceiling.
+    Stat-ing a file in a tight loop hammers the metadata server of a parallel filesystem and eats a whole core.
+    """
+
+    def __init__(self, initial=1.0e-4, ceiling=0.1, factor=2.0):
+        self.initial = float(initial)
+        self.ceiling = float(ceiling)
+        self.factor = float(factor)
+        self.Reset()
+
+
+    def Reset(self):
+        self.interval = self.initial
+
+
+    def Watch(self, path):
+        pass
+
+
+    def Backoff(self):
+        self.interval = min(self.interval * self.factor, self.ceiling)
+
+
+    def Sleep(self):
+        time.sleep(self.interval)
+        self.Backoff()
+
+
+    def Until(self, check, path=None):
+        self.Reset()
+        if path is not None:
+            self.Watch(path)
+        while not check():
+            self.Sleep()
+
+
+class SpinWait(PollWait):
+    """ The old behavior: check again immediately """
+
+    def Sleep(self):
+        pass
+
+
+class InotifyWait(PollWait):
+    """
+    Block on inotify events from the directories being watched, but never longer than the backoff interval.
+    inotify only sees changes made from the local node, so the backoff is still what catches writes from other nodes.
+    Falls back to plain PollWait where inotify isn't available.
+    """
+
+    # IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    mask = 0x00000002 | 0x00000008 | 0x00000040 | 0x00000080 | 0x00000100 | 0x00000200
+
+    def __init__(self, initial=1.0e-4, ceiling=0.1, factor=2.0):
+        super(InotifyWait, self).__init__(initial=initial, ceiling=ceiling, factor=factor)
+        self.fd = None
+        self.failed = False
+        self.watched = {}
+
+
+    def Open(self):
+        # Only done on the first Watch, so ranks that never wait don't each hold an inotify instance (there are only max_user_instances of them)
+        if (self.fd is not None) or self.failed:
+            return
+        try:
+            import ctypes
+            import ctypes.util
+            self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = self.libc.inotify_init1(os.O_NONBLOCK | getattr(os, "O_CLOEXEC", 0))
+        except (OSError, AttributeError, TypeError):
+            fd = -1
+        if fd >= 0:
+            self.fd = fd
+        else:
+            self.failed = True
+
+
+    def Watch(self, path):
+        self.Open()
+        if self.fd is None:
+            return
+
+        # Watch the closest existing directory, the creation of anything below it will wake us up
+        dirname = os.path.dirname(os.path.abspath(path))
+        while (not os.path.isdir(dirname)) and (dirname != os.path.dirname(dirname)):
+            dirname = os.path.dirname(dirname)
+        if dirname in self.watched:
+            return
+
+        wd = self.libc.inotify_add_watch(self.fd, dirname.encode('utf-8'), self.mask)
+        if wd >= 0:
+            self.watched[dirname] = wd
+
+
+    def Sleep(self):
+        if (self.fd is None) or (len(self.watched) == 0):
+            super(InotifyWait, self).Sleep()
+            return
+
+        ready, _, _ = select.select([self.fd], [], [], self.interval)
+        if len(ready) > 0:
+            self.Drain()
+        else:
+            self.Backoff()
+
+
+    def Drain(self):
+        while True:
+            try:
+                if len(os.read(self.fd, 4096)) == 0:
+                    break
+            except OSError:
+                break
+
+
+    def Close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            self.watched = {}
+
+
+    def __del__(self):
+        self.Close()
+
+
+def WaitStrategy(setting=None):
+    """
+    Build the waiter from a group's wait setting in .kittie-groups-N.yaml. Either a method name or a dictionary:
+        wait: {method: inotify, initial: 1.0e-4, ceiling: 0.1, factor: 2}
+    """
+
+    if setting is None:
+        setting = {}
+    elif not isinstance(setting, dict):
+        setting = {'method': setting}
+
+    kwargs = {}
+    for name in ['initial', 'ceiling', 'factor']:
+        if name in setting:
+            kwargs[name] = float(setting[name])
+
+    method = str(setting.get('method', 'inotify')).lower()
+    if method == 'inotify':
+        # Falls back to polling by itself, on the first Watch, if inotify can't be had
+        waiter = InotifyWait(**kwargs)
+    elif method in ['poll', 'backoff']:
+        waiter = PollWait(**kwargs)
+    elif method == 'spin':
+        waiter = SpinWait(**kwargs)
+    else:
+        raise ValueError("Unknown wait method: {0}".format(method))
+
+    return waiter
+
+
+class MetaIndex(object):
+    """
+    Tail the md.idx of a BP4 file. It's a 64 byte header, then one 64 byte record per step,
+    which the writer appends after everything else for the step is on disk -- so a complete record means a complete step.
+    """
+
+    HeaderSize = 64
+    RecordSize = 64
+
+    def __init__(self, filename):
+        self.filename = os.path.join(filename, 'md.idx')
+        self.steps = 0
+
+
+    def Refresh(self):
+        try:
+            size = os.path.getsize(self.filename)
+        except OSError:
+            return self.steps
+
+        if size > self.HeaderSize:
+            self.steps = (size - self.HeaderSize) // self.RecordSize
+        return self.steps
+
+
+    def Available(self, step):
+        if step < self.steps:
+            return True
+        return (self.Refresh() > step)
+
+
+def ThreadMultiple(comm=None):
+    """ Whether another thread can make MPI (and so ADIOS) calls while this one does; without MPI there's nothing to check """
+    if comm is None:
+        return True
+    from mpi4py import MPI
+    return (MPI.Query_thread() == MPI.THREAD_MULTIPLE)
+
+
+class StepWriter(object):
+    """
+    Write the <code>-step.bp records from a background thread.
+    Records are queued from write_step and flushed every interval seconds, or sooner once depth of them are waiting.
+    """
+
+    def __init__(self, io, engine, interval=1.0, depth=64):
+        self.io = io
+        self.engine = engine
+        self.interval = float(interval)
+        self.depth = int(depth)
+        self.records = queue.Queue(maxsize=self.depth)
+        self.wake = threading.Event()
+        self.stopping = False
+        self.error = None
+        self.thread = threading.Thread(target=self.Run, name="kittie-step-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def Push(self, number, physical):
+        # If the thread has died, say so here instead of waiting forever on a queue no one empties
+        while True:
+            if self.error is not None:
+                raise self.error
+            if self.records.full():
+                self.wake.set()
+            try:
+                self.records.put((number, physical), timeout=self.interval)
+                break
+            except queue.Full:
+                continue
+
+
+    def Write(self, records):
+        vNumber = self.io.InquireVariable("StepNumber")
+        vPhysical = self.io.InquireVariable("StepPhysical")
+        for number, physical in records:
+            self.engine.BeginStep()
+            self.engine.Put(vNumber, number)
+            self.engine.Put(vPhysical, physical)
+            self.engine.EndStep()
+
+
+    def Flush(self):
+        records = []
+        while True:
+            try:
+                records += [self.records.get_nowait()]
+            except queue.Empty:
+                break
+        if len(records) > 0:
+            self.Write(records)
+
+
+    def Run(self):
+        try:
+            while True:
+                self.wake.wait(self.interval)
+                self.wake.clear()
+                stopping = self.stopping
+                self.Flush()
+                if stopping:
+                    break
+        except Exception as e:
+            self.error = e
+
+
+    def Drain(self):
+        self.stopping = True
+        self.wake.set()
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        self.Flush()
+
+
+class TimerStats(object):
+    """
+    Running statistics for one timer: Welford mean/variance, min/max,
+    and percentiles from a histogram with log-spaced bins (20 per decade, 1 ns to 1e5 s).
+    """
+
+    PerDecade = 20
+    Lowest = -9
+    Highest = 5
+    Percentiles = [50, 90, 99]
+
+    def __init__(self):
+        self.calls = 0
+        self.mean = 0.0
+        self.M2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.bins = np.zeros((self.Highest - self.Lowest) * self.PerDecade + 2, dtype=np.int64)
+
+
+    def Add(self, values):
+        n = values.shape[0]
+        if n == 0:
+            return
+
+        # Chan et al. combination of the running moments with the batch's
+        mean = np.mean(values)
+        M2 = np.sum((values - mean)**2)
+        total = self.calls + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.M2 += M2 + delta**2 * self.calls * n / total
+        self.calls = total
+        self.min = min(self.min, np.amin(values))
+        self.max = max(self.max, np.amax(values))
+
+        logs = np.log10(np.maximum(values, 10.0**self.Lowest))
+        index = np.floor((logs - self.Lowest) * self.PerDecade).astype(np.int64) + 1
+        index = np.clip(index, 0, self.bins.shape[0] - 1)
+        self.bins += np.bincount(index, minlength=self.bins.shape[0])
+
+
+    @property
+    def std(self):
+        if self.calls < 2:
+            return 0.0
+        return np.sqrt(self.M2 / (self.calls - 1))
+
+
+    def Percentile(self, q):
+        if self.calls == 0:
+            return 0.0
+        index = np.searchsorted(np.cumsum(self.bins), q / 100.0 * self.calls)
+        value = 10.0**(self.Lowest + (index - 0.5) / self.PerDecade)
+        return min(max(value, self.min), self.max)
+
+
+    def Summary(self):
+        summary = {'calls': self.calls, 'min': self.min, 'max': self.max, 'mean': self.mean, 'std': self.std}
+        for q in self.Percentiles:
+            summary['p{0}'.format(q)] = self.Percentile(q)
+        return summary
+
+
+class Timer(object):
+    """
+    Buffer a timer's measurements in memory and write them flush at a time, as one [ranks, flush] block per ADIOS step.
+    count says how many entries of each rank's row are filled; the running statistics ride along in every step.
+    """
+
+    StatNames = ['min', 'max', 'mean', 'std'] + ['p{0}'.format(q) for q in TimerStats.Percentiles]
+
+    def __init__(self, io, filename, comm=None, flush=100):
+        self.io = io
+        self.flush = int(flush)
+        self.start = None
+        self.stop = None
+        self.stats = TimerStats()
+        self.buffer = np.zeros((1, self.flush), dtype=np.float64)
+        self.count = np.zeros(1, dtype=np.int64)
+        self.values = {}
+        for name in self.StatNames:
+            self.values[name] = np.zeros(1, dtype=np.float64)
+        self.values['calls'] = np.zeros(1, dtype=np.int64)
+
+        if comm is not None:
+            rank = comm.Get_rank()
+            size = comm.Get_size()
+        else:
+            rank = 0
+            size = 1
+
+        self.vTime = self.io.DefineVariable('time', self.buffer, [size, self.flush], [rank, 0], [1, self.flush])
+        self.vCount = self.io.DefineVariable('count', self.count, [size], [rank], [1])
+        self.vStats = {}
+        for name in self.values:
+            self.vStats[name] = self.io.DefineVariable(name, self.values[name], [size], [rank], [1])
+
+        if comm is not None:
+            self.engine = self.io.Open(filename, adios2.Mode.Write, comm)
+        else:
+            self.engine = self.io.Open(filename, adios2.Mode.Write)
+
+
+    def Record(self, diff):
+        self.buffer[0, self.count[0]] = diff
+        self.count[0] += 1
+        if self.count[0] == self.flush:
+            self.Flush()
+
+
+    def Flush(self):
+        self.stats.Add(self.buffer[0, :self.count[0]])
+        summary = self.stats.Summary()
+        for name in self.values:
+            self.values[name][0] = summary[name]
+
+        self.engine.BeginStep()
+        self.engine.Put(self.vTime, self.buffer)
+        self.engine.Put(self.vCount, self.count)
+        for name in self.values:
+            self.engine.Put(self.vStats[name], self.values[name])
+        self.engine.EndStep()
+        self.count[0] = 0
+
+
+    def Close(self):
+        # Collective, so flush whether or not this rank has anything left
+        self.Flush()
+        self.engine.Close()
+
+
+class Region(object):
+    """ One node in a rank's tree of nested timer regions. Times are integer nanoseconds """
+
+    def __init__(self, name, parent=None):
+        self.name = name
+        self.parent = parent
+        self.children = {}
+        self.count = 0
+        self.inclusive = 0
+        self.childtime = 0
+        self.begin = None
+
+
+    def Child(self, name):
+        if name not in self.children:
+            self.children[name] = Region(name, parent=self)
+        return self.children[name]
+
+
+    @property
+    def exclusive(self):
+        return self.inclusive - self.childtime
+
+
+    @property
+    def path(self):
+        if self.parent is None:
+            return ()
+        return self.parent.path + (self.name,)
+
+
+    def Walk(self):
+        for name in self.children:
+            yield self.children[name]
+            for region in self.children[name].Walk():
+                yield region
+
+
+class RegionTree(object):
+    """
+    Call tree of the nested start_timer/stop_timer regions on this rank, with counts, inclusive and exclusive time.
+    Finalize writes it to <timingdir>/<code>-regions.bp as columns over the union of every rank's regions:
+    the region paths (attribute), parent index, and [ranks, regions] count/inclusive/exclusive.
+    """
+
+    def __init__(self):
+        self.root = Region(None)
+        self.stack = [self.root]
+
+
+    def Start(self, name, now):
+        # Starting the innermost region again just restarts it, like the flat timers
+        if self.stack[-1].name == name:
+            self.stack[-1].begin = now
+            return
+        region = self.stack[-1].Child(name)
+        region.begin = now
+        self.stack += [region]
+
+
+    def Stop(self, name, now):
+        names = [region.name for region in self.stack[1:]]
+        if name not in names:
+            return False
+
+        # Stopping an outer region closes whatever was left open inside it
+        while True:
+            region = self.stack.pop()
+            elapsed = now - region.begin
+            region.count += 1
+            region.inclusive += elapsed
+            region.parent.childtime += elapsed
+            if region.name == name:
+                break
+        return True
+
+
+    def Write(self, adios, filename, comm=None):
+        regions = {}
+        for region in self.root.Walk():
+            regions[region.path] = region
+
+        if comm is not None:
+            rank = comm.Get_rank()
+            size = comm.Get_size()
+            allpaths = comm.gather(list(regions.keys()), root=0)
+            paths = None
+            if rank == 0:
+                paths = sorted(set([path for ranklist in allpaths for path in ranklist]))
+            paths = comm.bcast(paths, root=0)
+        else:
+            rank = 0
+            size = 1
+            paths = sorted(regions.keys())
+
+        if len(paths) == 0:
+            return
+
+        # Sorting the path tuples puts every parent before its children
+        n = len(paths)
+        lookup = dict(zip(paths, range(n)))
+        parent = np.array([lookup.get(path[:-1], -1) for path in paths], dtype=np.int64)
+        columns = {}
+        for name, dtype in [('count', np.int64), ('inclusive', np.float64), ('exclusive', np.float64)]:
+            columns[name] = np.zeros((1, n), dtype=dtype)
+        for path in regions:
+            i = lookup[path]
+            columns['count'][0, i] = regions[path].count
+            columns['inclusive'][0, i] = regions[path].inclusive * 1.0e-9
+            columns['exclusive'][0, i] = regions[path].exclusive * 1.0e-9
+
+        io = adios.DeclareIO("kittie-regions")
+        io.DefineAttribute("regions", ['/'.join(path) for path in paths])
+        variables = {}
+        for name in columns:
+            variables[name] = io.DefineVariable(name, columns[name], [size, n], [rank, 0], [1, n])
+        if rank == 0:
+            variables['parent'] = io.DefineVariable('parent', parent, [n], [0], [n])
+            columns['parent'] = parent
+
+        if comm is not None:
+            engine = io.Open(filename, adios2.Mode.Write, comm)
+        else:
+            engine = io.Open(filename, adios2.Mode.Write)
+        engine.BeginStep()
+        for name in variables:
+            engine.Put(variables[name], columns[name])
+        engine.EndStep()
+        engine.Close()
 
 
 class Coupler(object):
@@ -27,12 +570,32 @@ class Coupler(object):
         self.lockfile = False
         self.metafile = False
 
+        settings = {}
+        if groupname in Kittie.YamlEngineSettings:
+            settings = Kittie.YamlEngineSettings[groupname]
+        self.wait = WaitStrategy(settings.get('wait', None))
+
+        # The lock waits inside FileSeek reset self.wait every time, so retrying FileSeek backs off with its own
+        self.retry = WaitStrategy(settings.get('wait', None))
+
+        # incremental: keep the reader open between steps and resume from the last step instead of rescanning from step 0
+        self.seek = str(settings.get('seek', 'rescan')).lower()
+        if self.seek not in ['rescan', 'incremental']:
+            raise ValueError("Unknown seek mode for {0}: {1}".format(groupname, self.seek))
+        self.SeekStep = -1
+        self.index = None
+        self.variables = {}
+        self.buffers = BufferPool()
+
+        # lock-free: no lock files at all, readers only take steps whose md.idx record is complete (BP4 only)
+        self.coupling = str(settings.get('coupling', 'lock')).lower()
+        if self.coupling not in ['lock', 'lock-free']:
+            raise ValueError("Unknown coupling mode for {0}: {1}".format(groupname, self.coupling))
+
 
     def UntilNonexistentRead(self, verify=3):
         redo = False
-        exists = True
-        while exists:
-            exists = os.path.exists(self.writing)
+        self.wait.Until(lambda: not os.path.exists(self.writing), path=self.writing)
 
         self.reading = Kittie.Touch(self.reading)
         for i in range(verify):
@@ -47,9 +610,7 @@ class Coupler(object):
     def UntilNonexistentWrite(self):
         self.writing = Kittie.Touch(self.writing)
         for name in self.AllReading:
-            exists = True
-            while exists:
-                exists = os.path.exists(name)
+            self.wait.Until(lambda: not os.path.exists(name), path=name)
 
 
     def ReleaseLock(self):
@@ -65,8 +626,8 @@ class Coupler(object):
 
     def WaitDataExistence(self):
         if self.metafile:
-            while not os.path.exists(os.path.join(self.filename, 'md.idx')):
-                continue
+            idxfile = os.path.join(self.filename, 'md.idx')
+            self.wait.Until(lambda: os.path.exists(idxfile), path=idxfile)
 
 
 
@@ -112,10 +673,15 @@ class Coupler(object):
             else:
                 self.rank = 0
 
-            if self.io.EngineType().lower() in Kittie.FileMethods:
+            self.EngineType = self.io.EngineType().lower()
+            if self.EngineType in Kittie.FileMethods:
                 self.lockfile = True
-            if self.io.EngineType().lower() in Kittie.MetaMethods:
+            if self.EngineType in Kittie.MetaMethods:
                 self.metafile = True
+            if self.coupling == 'lock-free':
+                if self.EngineType not in Kittie.IndexMethods:
+                    raise ValueError("Lock-free coupling for {0} needs a BP4 engine, not {1}".format(self.groupname, self.io.EngineType()))
+                self.lockfile = False
 
         if not self.opened:
             if (self.groupname in Kittie.YamlEngineSettings) and ('filename' in Kittie.YamlEngineSettings[self.groupname]):
@@ -123,6 +689,10 @@ class Coupler(object):
             else:
                 self.filename = filename
 
+            # Only BP4 writes md.idx; incremental seeking on other engines still works, just without the index to check first
+            if (self.EngineType in Kittie.IndexMethods) and ((self.seek == 'incremental') or (self.coupling == 'lock-free')):
+                self.index = MetaIndex(self.filename)
+
             self.writing = self.filename + Kittie.writing
             self.reading = self.filename + Kittie.MyReading
             self.AllReading = []
@@ -132,9 +702,86 @@ class Coupler(object):
             self.CoupleOpen()
 
 
+    def CloseRead(self):
+        self.engine.Close()
+        self.opened = False
+        self.SeekStep = -1
+        self.io.RemoveAllVariables()
+        self.io.RemoveAllAttributes()
+        self.variables = {}
+
+
+    def IndexHas(self, step):
+        # Only rank 0 touches the filesystem. Check for .done first, so a step landing in between isn't mistaken for the end
+        available, done = False, False
+        if self.rank == 0:
+            done = os.path.exists(self.filename + ".done")
+            available = self.index.Available(step)
+        if self.comm is not None:
+            available, done = self.comm.bcast((available, done), root=0)
+        return available, done
+
+
+    def IndexWait(self, step, timeout):
+        # Rank 0 waits on the index and tells everyone else, so the collective BeginStep is entered (or not) together
+        statuses = [adios2.StepStatus.OK, adios2.StepStatus.NotReady, adios2.StepStatus.EndOfStream]
+        code = None
+
+        if self.rank == 0:
+            start = time.time()
+            self.wait.Reset()
+            self.wait.Watch(self.index.filename)
+            while code is None:
+                done = os.path.exists(self.filename + ".done")
+                if self.index.Available(step):
+                    code = 0
+                elif done:
+                    code = 2
+                elif (timeout > -1.0) and ((time.time() - start) >= timeout):
+                    code = 1
+                else:
+                    self.wait.Sleep()
+
+        if self.comm is not None:
+            code = self.comm.bcast(code, root=0)
+        return statuses[code]
+
+
+    def IndexSeek(self, step, timeout):
+        """
+        BeginStep only ever gives the engine's next step, so once step's record is in the index, walk forward to it.
+        The reader stays open, so earlier steps can't be gone back to.
+        """
+        if step <= self.CurrentStep:
+            raise ValueError("Lock-free coupling for {0} only reads forward: asked for step {1} after step {2}".format(self.groupname, step, self.CurrentStep))
+
+        status = self.IndexWait(step, timeout)
+        while status == adios2.StepStatus.OK:
+            status = self.engine.BeginStep(Kittie.ReadStepMode, timeout)
+            if status != adios2.StepStatus.OK:
+                break
+            self.CurrentStep += 1
+            if self.CurrentStep == step:
+                break
+            self.engine.EndStep()
+        return status
+
+
     def FileSeek(self, found, step, timeout):
-        CurrentStep = -1
         self.WaitDataExistence()
+
+        # Nothing new in the index means there's no reason to go through ADIOS (or the locks) at all
+        if self.index is not None:
+            available, done = self.IndexHas(step)
+            if done and (not available):
+                return adios2.StepStatus.EndOfStream, found
+            elif not available:
+                return adios2.StepStatus.NotReady, found
+
+        # Can only walk forward from where the open engine is
+        if self.opened and (step <= self.SeekStep):
+            self.CloseRead()
+
         self.AcquireLock()
         if not self.opened:
             if self.comm is not None:
@@ -142,12 +789,14 @@ class Coupler(object):
             else:
                 self.engine = self.io.Open(self.filename, self.mode)
             self.opened = True
+        CurrentStep = self.SeekStep
 
         while True:
             status = self.engine.BeginStep(Kittie.ReadStepMode, timeout)
 
             if status == adios2.StepStatus.OK:
                 CurrentStep += 1
+                self.SeekStep = CurrentStep
             else:
                 break
 
@@ -160,10 +809,7 @@ class Coupler(object):
 
         self.ReleaseLock()
         if not found:
-            self.engine.Close()
-            self.opened = False
-            self.io.RemoveAllVariables()
-            self.io.RemoveAllAttributes()
+            self.CloseRead()
             if not os.path.exists(self.filename + ".done"):
                 status = adios2.StepStatus.NotReady
 
@@ -181,21 +827,33 @@ class Coupler(object):
             status = adios2.StepStatus.OK
 
         elif self.mode == adios2.Mode.Read:
+            # Streaming engines (SST and the like) remake their variables in every BeginStep, so only file handles are kept across steps
+            if self.EngineType not in Kittie.MetaMethods:
+                self.variables = {}
+
             if step is None:
                 usestep = self.CurrentStep + 1
             else:
                 usestep = step
 
             if self.lockfile:
+                self.retry.Reset()
                 while not found:
                     status, found = self.FileSeek(found, usestep, timeout)
-                    if (timeout > -1.0):
+                    if (timeout > -1.0) or (status == adios2.StepStatus.EndOfStream):
                         break
+                    elif not found:
+                        self.retry.Sleep()
             else:
                 if not self.opened:
                     self.CoupleOpen()
 
-                status = self.engine.BeginStep(Kittie.ReadStepMode, timeout)
+                if self.coupling == 'lock-free':
+                    status = self.IndexSeek(usestep, timeout)
+                else:
+                    status = self.engine.BeginStep(Kittie.ReadStepMode, timeout)
+                    if status == adios2.StepStatus.OK:
+                        self.CurrentStep += 1
 
         self.BegunStepping = True
         return status
@@ -205,14 +863,55 @@ class Coupler(object):
         if (not self.FindStep) and ((self.groupname in Kittie.StepGroups) or Kittie.AllStep):
             self.FindStep = True
             if (self.mode == adios2.Mode.Write) and (self.rank == 0):
-                self.io.DefineVariable("_StepNumber", Kittie.StepNumber, [], [], [])
-                self.io.DefineVariable("_StepPhysical", Kittie.StepPhysical, [], [], [])
+                self.variables["_StepNumber"] = self.io.DefineVariable("_StepNumber", Kittie.StepNumber, [], [], [])
+                self.variables["_StepPhysical"] = self.io.DefineVariable("_StepPhysical", Kittie.StepPhysical, [], [], [])
 
         if self.FindStep and (self.mode == adios2.Mode.Write) and (self.rank == 0):
-            vNumber = self.io.InquireVariable("_StepNumber")
-            vPhysical = self.io.InquireVariable("_StepPhysical")
-            self.engine.Put(vNumber, Kittie.StepNumber)
-            self.engine.Put(vPhysical, Kittie.StepPhysical)
+            self.engine.Put(self.Variable("_StepNumber"), Kittie.StepNumber)
+            self.engine.Put(self.Variable("_StepPhysical"), Kittie.StepPhysical)
+
+
+    def Variable(self, name):
+        if name not in self.variables:
+            varid = self.io.InquireVariable(name)
+            if varid is None:
+                raise ValueError("Variable {0} not found in group {1}".format(name, self.groupname))
+            self.variables[name] = varid
+        return self.variables[name]
+
+
+    def put_many(self, data):
+        """ Put each {name: array} with cached variable handles, all deferred until end_step """
+        for name in data:
+            self.engine.Put(self.Variable(name), data[name])
+
+
+    def get_many(self, names, selections=None):
+        """
+        Get each of names, with optional {name: (starts, counts)} selections (the whole variable otherwise), as one batch.
+        The arrays returned are reused by later calls for the same name (until its shape or type changes) -- copy them to keep them.
+        """
+
+        if selections is None:
+            selections = {}
+        data = {}
+        for name in names:
+            varid = self.Variable(name)
+            shape = varid.Shape()
+            if name in selections:
+                starts, counts = selections[name]
+                varid.SetSelection([list(starts), list(counts)])
+                shape = counts
+            elif len(shape) > 0:
+                varid.SetSelection([[0]*len(shape), list(shape)])
+
+            if len(shape) == 0:
+                shape = [1]
+            data[name] = self.buffers.Get(name, shape, GetType(varid))
+            self.engine.Get(varid, data[name])
+
+        self.engine.PerformGets()
+        return data
 
 
     def end_step(self):
@@ -222,11 +921,8 @@ class Coupler(object):
         self.engine.EndStep()
         if self.lockfile:
             self.ReleaseLock()
-            if self.mode == adios2.Mode.Read:
-                self.engine.Close()
-                self.opened = False
-                self.io.RemoveAllVariables()
-                self.io.RemoveAllAttributes()
+            if (self.mode == adios2.Mode.Read) and (self.seek != 'incremental'):
+                self.CloseRead()
 
 
     def close(self):
@@ -251,6 +947,7 @@ class Kittie(object):
     adios = None
     FileMethods = ["bpfile", "bp", "bp3", "hdf5"]
     MetaMethods = ["bpfile", "bp", "bp3", "bp4", "hdf5"]
+    IndexMethods = ["bpfile", "bp", "bp4"]
 
     # Getting the list of all group names found in pre-processing doesn't seem to be needed
     #CompileGroups = []
@@ -260,11 +957,11 @@ class Kittie(object):
     AllReading = []
     Couplers = {}
     Timers = {}
+    TimerFlush = 100
+    StepWriter = None
 
-    if OldStep:
-        ReadStepMode = adios2.StepMode.NextAvailable
-    else:
-        ReadStepMode = adios2.StepMode.Read
+    # Set in Initialize, so adios2 isn't imported just by defining the class
+    ReadStepMode = None
 
 
     #######################
@@ -274,6 +971,7 @@ class Kittie(object):
     @classmethod
     def Touch(cls, name):
         if cls.touch:
+            import subprocess
             subprocess.call(["touch", name])
         else:
             try:
@@ -302,12 +1000,33 @@ class Kittie(object):
     """
 
 
+    @classmethod
+    def ReadConfig(cls, basename):
+        """
+        Only rank 0 reads the file, then broadcasts it, so startup doesn't scale with the rank count.
+        The .json that kittie-compose.py writes next to the .yaml loads without PyYAML; the .yaml is the fallback.
+        """
+
+        config = None
+        if cls.rank == 0:
+            if os.path.exists(basename + ".json"):
+                import json
+                with open(basename + ".json", 'r') as jstream:
+                    config = json.load(jstream)
+            elif os.path.exists(basename + ".yaml"):
+                with open(basename + ".yaml", 'r') as ystream:
+                    config = yaml.load(ystream)
+
+        if cls.comm is not None:
+            config = cls.comm.bcast(config, root=0)
+        return config
+
+
     @classmethod
     def GroupsYaml(cls):
-        yamlfile = ".kittie-groups-" + os.environ["KITTIE_NUM"] + ".yaml"
-        if os.path.exists(yamlfile):
-            with open(yamlfile, 'r') as ystream:
-                cls.YamlEngineSettings = yaml.load(ystream)
+        config = cls.ReadConfig(".kittie-groups-" + os.environ["KITTIE_NUM"])
+        if config is not None:
+            cls.YamlEngineSettings = config
             cls.timingdir = cls.YamlEngineSettings['.timingdir']
             del cls.YamlEngineSettings['.timingdir']
             for name in cls.YamlEngineSettings:
@@ -317,10 +1036,8 @@ class Kittie(object):
 
     @classmethod
     def CodesYaml(cls, readid=""):
-        yamlfile =  ".kittie-codenames-" + os.environ["KITTIE_NUM"] + ".yaml"
-        if os.path.exists(yamlfile):
-            with open(yamlfile, 'r') as ystream:
-                config = yaml.load(ystream)
+        config = cls.ReadConfig(".kittie-codenames-" + os.environ["KITTIE_NUM"])
+        if config is not None:
             cls.Codename = config["codename"]
             cls.MyReading = cls.reading + "-" + cls.Codename + readid
             for name in config["codes"]:
@@ -357,7 +1074,13 @@ class Kittie(object):
         cls.GroupsYaml()
         cls.CodesYaml(readid=readid)
 
+        if cls.OldStep:
+            cls.ReadStepMode = adios2.StepMode.NextAvailable
+        else:
+            cls.ReadStepMode = adios2.StepMode.Read
+
         cls.StepInit = False
+        cls.Regions = RegionTree()
         #cls.StepGroupname = cls.appname + "-step"
         cls.StepGroupname = cls.Codename + "-step"
 
@@ -370,7 +1093,15 @@ class Kittie(object):
             if (cls.rank == 0) and (cls.Couplers[name].mode == adios2.Mode.Write):
                 filename = cls.Touch(filename)
 
+        for name in cls.Timers.keys():
+            cls.Timers[name].Close()
+        if hasattr(cls, 'timingdir'):
+            filename = os.path.join(cls.timingdir, "{0}-regions.bp".format(cls.Codename))
+            cls.Regions.Write(cls.adios, filename, comm=cls.comm)
+
         if cls.StepInit:
+            if cls.StepWriter is not None:
+                cls.StepWriter.Drain()
             with open(cls.StepGroupname + ".done", "w") as outfile:
                 outfile.write("{0}".format(Kittie.StepNumber[0]))
             cls.StepEngine.Close()
@@ -407,6 +1138,16 @@ class Kittie(object):
         return cls.Couplers[groupname].engine
 
 
+    @classmethod
+    def put_many(cls, groupname, data):
+        cls.Couplers[groupname].put_many(data)
+
+
+    @classmethod
+    def get_many(cls, groupname, names, selections=None):
+        return cls.Couplers[groupname].get_many(names, selections=selections)
+
+
     @classmethod
     def write_step(cls, physical, number, comm=None):
         if cls.rank == 0:
@@ -426,55 +1167,55 @@ class Kittie(object):
                     cls.StepEngine = cls.StepIO.Open(cls.StepGroupname + ".bp", adios2.Mode.Write)
                 else:
                     cls.StepEngine = cls.StepIO.Open(cls.StepGroupname + ".bp", adios2.Mode.Write, cls.comm_self)
+
+                # flush-interval: 0 writes each step in place, like it used to.
+                # The writer thread's ADIOS calls run alongside the main thread's MPI ones, which is only allowed with MPI_THREAD_MULTIPLE.
+                settings = cls.YamlEngineSettings.get(cls.StepGroupname, {})
+                interval = float(settings.get('flush-interval', 1.0))
+                depth = int(settings.get('queue-depth', 64))
+                if (interval > 0) and (not ThreadMultiple(cls.comm_self)):
+                    warnings.warn("MPI isn't initialized with MPI_THREAD_MULTIPLE, writing {0} synchronously".format(cls.StepGroupname))
+                    interval = 0
+                if interval > 0:
+                    cls.StepWriter = StepWriter(cls.StepIO, cls.StepEngine, interval=interval, depth=depth)
                 cls.StepInit = True
 
-            cls.StepEngine.BeginStep()
-            vNumber = cls.StepIO.InquireVariable("StepNumber")
-            vPhysical = cls.StepIO.InquireVariable("StepPhysical")
-            cls.StepEngine.Put(vNumber, cls.StepNumber)
-            cls.StepEngine.Put(vPhysical, cls.StepPhysical)
-            cls.StepEngine.EndStep()
+            if cls.StepWriter is not None:
+                cls.StepWriter.Push(cls.StepNumber, cls.StepPhysical)
+            else:
+                cls.StepEngine.BeginStep()
+                vNumber = cls.StepIO.InquireVariable("StepNumber")
+                vPhysical = cls.StepIO.InquireVariable("StepPhysical")
+                cls.StepEngine.Put(vNumber, cls.StepNumber)
+                cls.StepEngine.Put(vPhysical, cls.StepPhysical)
+                cls.StepEngine.EndStep()
 
 
     @classmethod
-    def start_timer(cls, name, comm=None):
+    def start_timer(cls, name, comm=None, flush=None):
         if name not in cls.Timers:
-            cls.Timers[name] = {}
-            firstgroup = list(cls.YamlEngineSettings.keys())[0]
             timefile = os.path.join(cls.timingdir, "{0}.bp".format(name))
-            cls.Timers[name]['diff'] = np.zeros(1)
-
-            cls.Timers[name]['io'] = cls.adios.DeclareIO(name)
             if (comm is None) and (cls.comm is not None):
                 comm = cls.comm
+            if flush is None:
+                flush = cls.TimerFlush
+            cls.Timers[name] = Timer(cls.adios.DeclareIO(name), timefile, comm=comm, flush=flush)
 
-            if comm is not None:
-                from mpi4py import MPI
-                cls.Wtime = MPI.Wtime
-                rank = comm.Get_rank()
-                size = comm.Get_size()
-                cls.Timers[name]['io'].DefineVariable('time', cls.Timers[name]['diff'], [size], [rank], [1])
-                cls.Timers[name]['engine'] = cls.Timers[name]['io'].Open(timefile, adios2.Mode.Write, comm)
-
-            else:
-                cls.Wtime = time.time
-                cls.Timers[name]['io'].DefineVariable('time', cls.Timers[name]['diff'], [1], [0], [1])
-                cls.Timers[name]['engine'] = cls.Timers[name]['io'].Open(timefile, adios2.Mode.Write)
-
-        cls.Timers[name]['start'] = cls.Wtime()
+        now = time.perf_counter_ns()
+        cls.Timers[name].start = now
+        cls.Regions.Start(name, now)
 
 
     @classmethod
     def stop_timer(cls, name):
-        if (name in cls.Timers) and ('start' in cls.Timers[name].keys()):
-            if ('stop' not in cls.Timers[name].keys()) or (cls.Timers[name]['start'] > cls.Timers[name]['stop']):
-                cls.Timers[name]['stop'] = cls.Wtime()
-                var = cls.Timers[name]['io'].InquireVariable('time')
-                cls.Timers[name]['diff'][0] = cls.Timers[name]['stop'] - cls.Timers[name]['start']
-                cls.Timers[name]['engine'].BeginStep()
-                cls.Timers[name]['engine'].Put(var, cls.Timers[name]['diff'])
-                cls.Timers[name]['engine'].EndStep()
-                cls.Timers[name]['start'] = cls.Timers[name]['stop']
+        now = time.perf_counter_ns()
+        if (name in cls.Timers) and (cls.Timers[name].start is not None):
+            timer = cls.Timers[name]
+            if (timer.stop is None) or (timer.start > timer.stop):
+                timer.stop = now
+                timer.Record((timer.stop - timer.start) * 1.0e-9)
+                timer.start = timer.stop
+                cls.Regions.Stop(name, now)
             else:
                 warnings.warn("Found stop without matching start for timer {0}".format(name), RuntimeWarning)
 
@@ -482,26 +1223,11 @@ class Kittie(object):
             warnings.warn("Found stop without matching start for timer {0}".format(name), RuntimeWarning)
 
 
-def TimingRead(filename, comm=None):
-    if comm is not None:
-        adios = adios2.ADIOS(comm, adios2.DebugON)
-    else:
-        adios = adios2.ADIOS(adios2.DebugON)
-
-    TmpIO = adios.DeclareIO("tmp-{0}".format(filename))
-    TmpEngine = TmpIO.Open(filename, adios2.Mode.Read)
-    steps = TmpEngine.Steps()
-
-    data = {}
-    for name in ["start", "other", "end", "total"]:
-        var = TmpIO.InquireVariable(name)
-        shape = var.Shape()
-        var.SetSelection([[0], shape])
-        var.SetStepSelection([0, steps])
-        data[name] = np.zeros((steps, shape[0]))
-        TmpEngine.Get(var, data[name])
-
-    #TmpEngine.Flush()
-    TmpEngine.Close()
-    return data
-
+    @classmethod
+    @contextlib.contextmanager
+    def timer(cls, name, comm=None, flush=None):
+        cls.start_timer(name, comm=comm, flush=flush)
+        try:
+            yield
+        finally:
+            cls.stop_timer(name)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+# Let's keep everything tested with python 2 and python 3
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import glob
+import functools
+
+from kittie.kittie_common import LazyModule
+
+np = LazyModule("numpy")
+adios2 = LazyModule("adios2")
+
+
+def TimerFiles(timingdir):
+    files = sorted(glob.glob(os.path.join(timingdir, "*.bp")))
+    return [filename for filename in files if not filename.endswith("-regions.bp")]
+
+
+def TimerName(filename):
+    return os.path.splitext(os.path.basename(filename.rstrip('/')))[0]
+
+
+class TimerFile(object):
+    """
+    Step through one timer file, as written by Kittie.stop_timer: each step is a [ranks, flush] block of measurements
+    and count, the number of them each rank filled.
+    """
+
+    def __init__(self, filename, comm=None):
+        if comm is not None:
+            self.adios = adios2.ADIOS(comm, adios2.DebugON)
+        else:
+            self.adios = adios2.ADIOS(adios2.DebugON)
+        self.io = self.adios.DeclareIO("timing-{0}".format(filename))
+        self.engine = self.io.Open(filename, adios2.Mode.Read)
+        self.steps = self.engine.Steps()
+        self.vTime = self.io.InquireVariable("time")
+        self.vCount = self.io.InquireVariable("count")
+        self.ranks, self.flush = self.vTime.Shape()
+
+
+    def Read(self, step, rstart, rcount):
+        times = np.zeros((rcount, self.flush), dtype=np.float64)
+        counts = np.zeros(rcount, dtype=np.int64)
+        self.vTime.SetStepSelection([step, 1])
+        self.vTime.SetSelection([[rstart, 0], [rcount, self.flush]])
+        self.vCount.SetStepSelection([step, 1])
+        self.vCount.SetSelection([[rstart], [rcount]])
+        self.engine.Get(self.vTime, times, adios2.Mode.Sync)
+        self.engine.Get(self.vCount, counts, adios2.Mode.Sync)
+        return times, counts
+
+
+    def Chunks(self, rankchunk):
+        for step in range(self.steps):
+            for rstart in range(0, self.ranks, rankchunk):
+                rcount = min(rankchunk, self.ranks - rstart)
+                times, counts = self.Read(step, rstart, rcount)
+                yield step, rstart, times, counts
+
+
+    def Close(self):
+        self.engine.Close()
+
+
+def TimingRead(filename, comm=None):
+    """ Read a whole timer file into (iterations, ranks), with NaN where a rank didn't record. Only for small runs """
+    timer = TimerFile(filename, comm=comm)
+    data = np.full((timer.steps * timer.flush, timer.ranks), np.nan)
+    for step, rstart, times, counts in timer.Chunks(timer.ranks):
+        mask = np.arange(timer.flush)[np.newaxis, :] < counts[:, np.newaxis]
+        block = np.where(mask, times, np.nan)
+        data[step*timer.flush:(step+1)*timer.flush, rstart:rstart+times.shape[0]] = block.T
+    timer.Close()
+    return {'time': data}
+
+
+def Summarize(filename, rankchunk=4096, outlier=3.5):
+    """
+    Stream one timer file rank chunk by rank chunk, never holding more than [rankchunk, flush] of it, and return
+        max, mean:   per-iteration max and mean across ranks
+        imbalance:   max / mean per iteration
+        cumulative:  total time per rank
+        outliers:    ranks whose cumulative time is more than outlier robust (MAD) deviations from the median
+    """
+
+    timer = TimerFile(filename)
+    niter = timer.steps * timer.flush
+    summed = np.zeros(niter, dtype=np.float64)
+    maxed = np.full(niter, -np.inf)
+    nranks = np.zeros(niter, dtype=np.int64)
+    cumulative = np.zeros(timer.ranks, dtype=np.float64)
+    last = 0
+
+    for step, rstart, times, counts in timer.Chunks(rankchunk):
+        mask = np.arange(timer.flush)[np.newaxis, :] < counts[:, np.newaxis]
+        block = np.where(mask, times, 0.0)
+        it = slice(step*timer.flush, (step+1)*timer.flush)
+        summed[it] += np.sum(block, axis=0)
+        maxed[it] = np.maximum(maxed[it], np.amax(np.where(mask, times, -np.inf), axis=0))
+        nranks[it] += np.sum(mask, axis=0)
+        cumulative[rstart:rstart+times.shape[0]] += np.sum(block, axis=1)
+        if np.any(counts > 0):
+            last = max(last, step*timer.flush + np.amax(counts))
+
+    timer.Close()
+
+    nranks = nranks[:last]
+    mean = summed[:last] / np.maximum(nranks, 1)
+    maxed = np.where(nranks > 0, maxed[:last], 0.0)
+    imbalance = np.where(mean > 0, maxed / np.where(mean > 0, mean, 1.0), 1.0)
+
+    median = np.median(cumulative)
+    mad = np.median(np.fabs(cumulative - median)) * 1.4826
+    if mad > 0:
+        outliers = np.nonzero(np.fabs(cumulative - median) / mad > outlier)[0]
+    else:
+        outliers = np.zeros(0, dtype=np.int64)
+
+    return {'name': TimerName(filename), 'max': maxed, 'mean': mean, 'imbalance': imbalance, 'cumulative': cumulative, 'outliers': outliers}
+
+
+def SummarizeAll(timingdir, comm=None, processes=None, rankchunk=4096):
+    """
+    Summarize every timer in timingdir (e.g. effis-timing), files split over the ranks of comm, or else over a process pool.
+    Returns {timer: summary} (on rank 0 only when using comm).
+    """
+
+    files = TimerFiles(timingdir)
+
+    if comm is not None:
+        rank = comm.Get_rank()
+        size = comm.Get_size()
+        mine = [Summarize(filename, rankchunk=rankchunk) for filename in files[rank::size]]
+        results = comm.gather(mine, root=0)
+        if rank != 0:
+            return None
+        results = [summary for ranklist in results for summary in ranklist]
+
+    elif (processes == 1) or (len(files) < 2):
+        results = [Summarize(filename, rankchunk=rankchunk) for filename in files]
+
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes=processes)
+        try:
+            results = pool.map(functools.partial(Summarize, rankchunk=rankchunk), files)
+        finally:
+            pool.close()
+            pool.join()
+
+    summaries = {}
+    for summary in results:
+        summaries[summary['name']] = summary
+    return summaries
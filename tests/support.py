@@ -0,0 +1,39 @@
+"""
+What the tests share: the source directories on sys.path, and stand-ins for the modules that need MPI or ADIOS.
+Both only last while a test module has them started, and everything imported in the meantime is forgotten afterwards.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+import os
+import sys
+import importlib
+from unittest import mock
+
+# numpy can't be imported a second time once it's dropped from sys.modules, so it's loaded for good here
+importlib.import_module("numpy")
+
+top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+paths = [os.path.join(top, "src", "Python"), os.path.join(top, "util"), os.path.join(top, "plot")]
+
+
+class Stubbed(object):
+    """ Start before importing the code under test (setUpModule), stop when done with it (tearDownModule) """
+
+    def __init__(self, *names):
+        stubs = {}
+        for name in names:
+            try:
+                importlib.import_module(name)
+            except ImportError:
+                stubs[name] = mock.MagicMock()
+        self.patchers = [mock.patch.dict(sys.modules, stubs), mock.patch.object(sys, "path", paths + sys.path)]
+
+
+    def start(self):
+        for patcher in self.patchers:
+            patcher.start()
+
+
+    def stop(self):
+        for patcher in self.patchers[::-1]:
+            patcher.stop()
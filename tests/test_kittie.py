@@ -0,0 +1,175 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import shutil
+import tempfile
+import importlib
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from support import Stubbed
+
+stubs = Stubbed("adios2", "yaml")
+kittie = None
+
+
+def setUpModule():
+    global kittie
+    stubs.start()
+    kittie = importlib.import_module("kittie.kittie")
+
+
+def tearDownModule():
+    stubs.stop()
+
+
+class TimerStatsTest(unittest.TestCase):
+
+    def test_moments(self):
+        values = np.random.RandomState(1).uniform(1.0e-3, 1.0, 1000)
+        stats = kittie.TimerStats()
+        for batch in np.split(values, 10):
+            stats.Add(batch)
+        self.assertEqual(stats.calls, 1000)
+        self.assertAlmostEqual(stats.mean, np.mean(values))
+        self.assertAlmostEqual(stats.std, np.std(values, ddof=1))
+        self.assertEqual(stats.min, np.amin(values))
+        self.assertEqual(stats.max, np.amax(values))
+
+    def test_percentiles(self):
+        # Good to a bin, which is a factor of 10**(1/20)
+        values = np.logspace(-6, 0, 10001)
+        stats = kittie.TimerStats()
+        stats.Add(values)
+        for q in [50, 90, 99]:
+            self.assertAlmostEqual(np.log10(stats.Percentile(q)), np.log10(np.percentile(values, q)), delta=0.06)
+
+    def test_empty(self):
+        stats = kittie.TimerStats()
+        stats.Add(np.zeros(0))
+        self.assertEqual(stats.calls, 0)
+        self.assertEqual(stats.Percentile(50), 0.0)
+        self.assertEqual(stats.std, 0.0)
+
+
+class RegionTreeTest(unittest.TestCase):
+
+    def test_nested(self):
+        tree = kittie.RegionTree()
+        tree.Start("outer", 0)
+        tree.Start("inner", 10)
+        self.assertTrue(tree.Stop("inner", 40))
+        tree.Start("inner", 50)
+        self.assertTrue(tree.Stop("inner", 60))
+        self.assertTrue(tree.Stop("outer", 100))
+
+        outer = tree.root.children["outer"]
+        inner = outer.children["inner"]
+        self.assertEqual((outer.count, outer.inclusive, outer.exclusive), (1, 100, 60))
+        self.assertEqual((inner.count, inner.inclusive, inner.exclusive), (2, 40, 40))
+        self.assertEqual(inner.path, ("outer", "inner"))
+        self.assertEqual([region.name for region in tree.root.Walk()], ["outer", "inner"])
+
+    def test_stop_outer_closes_inner(self):
+        tree = kittie.RegionTree()
+        tree.Start("outer", 0)
+        tree.Start("inner", 10)
+        self.assertTrue(tree.Stop("outer", 30))
+        self.assertEqual(tree.stack, [tree.root])
+        self.assertEqual(tree.root.children["outer"].children["inner"].inclusive, 20)
+
+    def test_unknown_and_restart(self):
+        tree = kittie.RegionTree()
+        self.assertFalse(tree.Stop("never", 5))
+        tree.Start("a", 0)
+        tree.Start("a", 10)
+        tree.Stop("a", 15)
+        self.assertEqual(tree.root.children["a"].inclusive, 5)
+        self.assertEqual(tree.root.children["a"].count, 1)
+
+
+class MetaIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.index = kittie.MetaIndex(self.dirname)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def Write(self, size):
+        with open(self.index.filename, 'wb') as outfile:
+            outfile.write(b"\0" * size)
+
+    def test_missing(self):
+        self.assertEqual(self.index.Refresh(), 0)
+        self.assertFalse(self.index.Available(0))
+
+    def test_records(self):
+        self.Write(kittie.MetaIndex.HeaderSize)
+        self.assertEqual(self.index.Refresh(), 0)
+
+        # A partly written record isn't a step yet
+        self.Write(kittie.MetaIndex.HeaderSize + 2*kittie.MetaIndex.RecordSize + 10)
+        self.assertEqual(self.index.Refresh(), 2)
+        self.assertTrue(self.index.Available(1))
+        self.assertFalse(self.index.Available(2))
+
+        self.Write(kittie.MetaIndex.HeaderSize + 3*kittie.MetaIndex.RecordSize)
+        self.assertTrue(self.index.Available(2))
+
+
+class CouplerTest(unittest.TestCase):
+
+    def setUp(self):
+        # Set by Initialize from the code's name
+        patcher = mock.patch.object(kittie.Kittie, "MyReading", ".reading-test", create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def Coupler(self, engine, **settings):
+        with mock.patch.dict(kittie.Kittie.YamlEngineSettings, {"group": settings}):
+            coupler = kittie.Coupler("group")
+        coupler.io = mock.Mock()
+        coupler.io.EngineType.return_value = engine
+        coupler.CoupleOpen = mock.Mock()
+        coupler.open("data.bp", kittie.adios2.Mode.Read)
+        return coupler
+
+    def test_index_only_for_bp4(self):
+        self.assertIsNone(self.Coupler("HDF5", seek="incremental").index)
+        self.assertIsNone(self.Coupler("BP3", seek="incremental").index)
+        self.assertIsNotNone(self.Coupler("BP4", seek="incremental").index)
+
+    def test_lock_free_skips_to_step(self):
+        OK = kittie.adios2.StepStatus.OK
+        coupler = self.Coupler("BP4", coupling="lock-free")
+        coupler.IndexWait = mock.Mock(return_value=OK)
+        coupler.engine = mock.Mock()
+        coupler.engine.BeginStep.return_value = OK
+
+        self.assertEqual(coupler.begin_step(), OK)
+        self.assertEqual(coupler.CurrentStep, 0)
+        coupler.engine.EndStep()
+
+        self.assertEqual(coupler.begin_step(step=3), OK)
+        self.assertEqual(coupler.CurrentStep, 3)
+        self.assertEqual(coupler.engine.BeginStep.call_count, 4)
+        coupler.IndexWait.assert_called_with(3, -1)
+
+        with self.assertRaises(ValueError):
+            coupler.begin_step(step=3)
+
+    def test_stream_handles_per_step(self):
+        for engine, inquiries in [("SST", 2), ("BP4", 1)]:
+            coupler = self.Coupler(engine)
+            coupler.engine = mock.Mock()
+            coupler.engine.BeginStep.return_value = kittie.adios2.StepStatus.OK
+            for i in range(2):
+                coupler.begin_step()
+                coupler.Variable("density")
+            self.assertEqual(coupler.io.InquireVariable.call_count, inquiries)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import importlib
+import unittest
+
+import numpy as np
+
+from support import Stubbed
+
+stubs = Stubbed()
+kittie_common = None
+
+
+def setUpModule():
+    global kittie_common
+    stubs.start()
+    kittie_common = importlib.import_module("kittie_common")
+
+
+def tearDownModule():
+    stubs.stop()
+
+
+class BufferPoolTest(unittest.TestCase):
+
+    def test_reuse(self):
+        pool = kittie_common.BufferPool()
+        a = pool.Get("a", [4, 5], np.float64)
+        self.assertEqual(a.shape, (4, 5))
+        self.assertIs(pool.Get("a", (4, 5), np.float64), a)
+        self.assertIsNot(pool.Get("b", (4, 5), np.float64), a)
+
+    def test_reallocate(self):
+        pool = kittie_common.BufferPool()
+        a = pool.Get("a", [4], np.float64)
+        b = pool.Get("a", [8], np.float64)
+        self.assertIsNot(b, a)
+        self.assertEqual(b.shape, (8,))
+        c = pool.Get("a", [8], np.int32)
+        self.assertEqual(c.dtype, np.int32)
+
+    def test_slots(self):
+        pool = kittie_common.BufferPool(slots=3)
+        arrays = [pool.Get("a", [2], np.float64) for i in range(4)]
+        self.assertEqual(len(set([id(array) for array in arrays[:3]])), 3)
+        self.assertIs(arrays[3], arrays[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import types
+import importlib
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from support import Stubbed
+
+stubs = Stubbed("adios2", "yaml")
+kittie_monitor = None
+
+
+def setUpModule():
+    global kittie_monitor
+    stubs.start()
+    kittie_monitor = importlib.import_module("kittie_monitor")
+
+
+def tearDownModule():
+    stubs.stop()
+
+
+class SplitSelectionTest(unittest.TestCase):
+
+    def test_plain(self):
+        self.assertEqual(kittie_monitor.SplitSelection("density"), ("density", None, 1))
+
+    def test_slice_and_stride(self):
+        self.assertEqual(kittie_monitor.SplitSelection("density[10:20, :]@4"), ("density", ["10:20", ":"], 4))
+        self.assertEqual(kittie_monitor.SplitSelection("density @ 2"), ("density", None, 2))
+
+    def test_bad_stride(self):
+        with self.assertRaises(ValueError):
+            kittie_monitor.SplitSelection("density@0")
+
+
+class SelectionBoxTest(unittest.TestCase):
+
+    def Box(self, shape, dims):
+        starts, counts, outshape = kittie_monitor.SelectionBox(shape, dims)
+        return list(starts), list(counts), outshape
+
+    def test_whole(self):
+        self.assertEqual(self.Box([4, 5], None), ([0, 0], [4, 5], (4, 5)))
+
+    def test_slices(self):
+        self.assertEqual(self.Box([10, 5], ["2:7", ":"]), ([2, 0], [5, 5], (5, 5)))
+        self.assertEqual(self.Box([10, 5], ["-3:", "1:"]), ([7, 1], [3, 4], (3, 4)))
+        self.assertEqual(self.Box([10, 5], ["8:20"]), ([8, 0], [2, 5], (2, 5)))
+
+    def test_index_drops_dimension(self):
+        self.assertEqual(self.Box([10, 5, 3], ["4", ":", "-1"]), ([4, 0, 2], [1, 5, 1], (5,)))
+
+    def test_step_slices(self):
+        with self.assertRaises(ValueError):
+            self.Box([10], ["::2"])
+
+
+class WorkerTargetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.user = types.ModuleType("user")
+        self.user.scale = lambda data, factor: np.multiply(data, factor, out=data)
+        patcher = mock.patch.object(kittie_monitor.MonitorGlobal, "module", self.user)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_paths(self):
+        self.assertEqual(kittie_monitor.ImportPath("scale"), (None, "scale"))
+        self.assertEqual(kittie_monitor.ImportPath("np.linalg.norm"), ("numpy", "linalg.norm"))
+        with self.assertRaises(ValueError):
+            kittie_monitor.ImportPath("Resolve")
+
+    def test_call(self):
+        # What works in-process has to work in the worker too, including the fallback to numpy
+        dst = np.zeros(3)
+        kittie_monitor.WorkerCall(kittie_monitor.ImportPath("np.copyto"), [(False, dst), (False, np.arange(3.0))])
+        self.assertEqual(list(dst), [0.0, 1.0, 2.0])
+
+        with mock.patch.object(importlib.import_module("kittie_workers").WorkerGlobal, "module", self.user):
+            kittie_monitor.WorkerCall(kittie_monitor.ImportPath("scale"), [(False, dst)], {'factor': 2.0})
+        self.assertEqual(list(dst), [0.0, 2.0, 4.0])
+
+    def test_unpicklable(self):
+        monitor = object.__new__(kittie_monitor.UserMonitor)
+        monitor.name = "bad"
+        monitor.fname = "scale"
+        monitor.args = [None, lambda: None]
+        monitor.slots = [(0, None)]
+        monitor.kwargs = {}
+        with self.assertRaises(ValueError):
+            monitor.WorkerTarget()
+        monitor.args = [None, 2.0]
+        monitor.WorkerTarget()
+        self.assertEqual(monitor.target, (None, "scale"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,161 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import importlib
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from support import Stubbed
+
+stubs = Stubbed("adios2")
+kittie_reductions = None
+
+
+def setUpModule():
+    global kittie_reductions
+    stubs.start()
+    kittie_reductions = importlib.import_module("kittie_reductions")
+
+
+def tearDownModule():
+    stubs.stop()
+
+
+class ReductionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.steps = [np.random.RandomState(i).normal(i, 1.0 + i, (20, 30)) for i in range(4)]
+        self.every = np.concatenate([step.ravel() for step in self.steps])
+
+    def test_abstract(self):
+        with self.assertRaises(TypeError):
+            kittie_reductions.Reduction()
+
+    def test_welford(self):
+        reduction = kittie_reductions.Welford()
+        for step in self.steps:
+            reduction(step)
+        results = reduction.Results()
+        self.assertEqual(reduction.steps, 4)
+        self.assertEqual(results['count'], self.every.shape[0])
+        self.assertAlmostEqual(results['mean'], np.mean(self.every))
+        self.assertAlmostEqual(results['var'], np.var(self.every))
+        self.assertEqual(results['min'], np.amin(self.every))
+        self.assertEqual(results['max'], np.amax(self.every))
+        self.assertAlmostEqual(results['step-mean'], np.mean(self.steps[-1]))
+
+    def test_histogram(self):
+        reduction = kittie_reductions.Histogram(bins=16, range=(-5, 5))
+        for step in self.steps:
+            reduction(step)
+        results = reduction.Results()
+        inside = np.count_nonzero((self.every >= -5) & (self.every <= 5))
+        self.assertEqual(np.sum(results['total']), inside)
+        self.assertEqual(results['under'] + results['over'], self.every.shape[0] - inside)
+        self.assertEqual(np.sum(results['counts']), np.count_nonzero(np.abs(self.steps[-1]) <= 5))
+
+    def test_histogram_auto_range(self):
+        reduction = kittie_reductions.Histogram(bins=8)
+        reduction(self.steps[0])
+        self.assertEqual(reduction.edges[0], np.amin(self.steps[0]))
+        self.assertEqual(reduction.edges[-1], np.amax(self.steps[0]))
+        self.assertEqual(np.sum(reduction.counts), self.steps[0].size)
+
+    def test_norm(self):
+        reduction = kittie_reductions.Norm()
+        for step in self.steps:
+            reduction(step)
+        results = reduction.Results()
+        last = self.steps[-1].ravel()
+        self.assertAlmostEqual(results['l1'], np.sum(np.abs(last)))
+        self.assertAlmostEqual(results['l2'], np.linalg.norm(last))
+        self.assertAlmostEqual(results['peak-linf'], np.amax(np.abs(self.every)))
+
+    def test_profile(self):
+        reduction = kittie_reductions.Profile(axis=1)
+        for step in self.steps:
+            reduction(step)
+        results = reduction.Results()
+        self.assertTrue(np.allclose(results['profile'], np.mean(self.steps[-1], axis=0)))
+        self.assertTrue(np.allclose(results['mean-profile'], np.mean([np.mean(step, axis=0) for step in self.steps], axis=0)))
+        with self.assertRaises(ValueError):
+            reduction(np.float64(1.0))
+
+    def test_percentiles(self):
+        reduction = kittie_reductions.Percentiles(q=(10, 50, 90), perdecade=40)
+        for step in self.steps:
+            reduction(step)
+        results = reduction.Results()
+        exact = np.percentile(self.every, [10, 50, 90])
+        self.assertTrue(np.allclose(results['percentiles'], exact, rtol=0.1, atol=0.05))
+
+
+class NanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clean = [np.random.RandomState(i).normal(0.0, 1.0, (10, 12)) for i in range(3)]
+        self.dirty = [step.copy() for step in self.clean]
+        self.dirty[0][0, :3] = np.nan
+        self.dirty[0][1, 0] = np.inf
+        self.dirty[2][:, 5] = np.nan
+        self.finite = np.concatenate([step[np.isfinite(step)] for step in self.dirty])
+
+    def Run(self, reduction):
+        for step in self.dirty:
+            reduction(step)
+        return reduction.Results()
+
+    def test_counted(self):
+        reduction = kittie_reductions.Welford()
+        reduction.io = mock.Mock()
+        reduction.io.DefineVariable.side_effect = lambda *args: mock.Mock()
+        reduction.engine = mock.Mock()
+        self.Run(reduction)
+
+        # What the last step wrote
+        names = dict([(id(varid), name) for name, varid in reduction.variables.items()])
+        written = dict([(names[id(call[0][0])], call[0][1]) for call in reduction.engine.Put.call_args_list])
+        self.assertEqual(reduction.nans, 10)
+        self.assertEqual(reduction.NanTotal, 14)
+        self.assertEqual(int(written['nan-count'][0]), 10)
+        self.assertEqual(int(written['nan-total'][0]), 14)
+
+    def test_welford(self):
+        results = self.Run(kittie_reductions.Welford())
+        self.assertEqual(results['count'], self.finite.shape[0])
+        self.assertAlmostEqual(results['mean'], np.mean(self.finite))
+        self.assertAlmostEqual(results['var'], np.var(self.finite))
+        self.assertEqual(results['min'], np.amin(self.finite))
+        self.assertEqual(results['max'], np.amax(self.finite))
+
+    def test_histogram_auto_range(self):
+        results = self.Run(kittie_reductions.Histogram(bins=8))
+        self.assertTrue(np.all(np.isfinite(results['edges'])))
+        first = self.dirty[0][np.isfinite(self.dirty[0])]
+        self.assertEqual(results['edges'][0], np.amin(first))
+        self.assertEqual(results['edges'][-1], np.amax(first))
+        self.assertEqual(np.sum(results['total']) + results['under'] + results['over'], self.finite.shape[0])
+
+    def test_norm_and_percentiles(self):
+        self.assertAlmostEqual(self.Run(kittie_reductions.Norm())['peak-linf'], np.amax(np.abs(self.finite)))
+        results = self.Run(kittie_reductions.Percentiles(q=(50,)))
+        self.assertTrue(np.all(np.isfinite(results['percentiles'])))
+
+    def test_profile(self):
+        results = self.Run(kittie_reductions.Profile(axis=1))
+        self.assertTrue(np.isnan(results['profile'][5]))
+        self.assertTrue(np.all(np.isfinite(results['mean-profile'])))
+        expected = np.mean([np.mean(self.clean[i][:, 5]) for i in range(2)])
+        self.assertAlmostEqual(results['mean-profile'][5], expected)
+
+    def test_all_nan_step(self):
+        reduction = kittie_reductions.Welford()
+        reduction(self.clean[0])
+        reduction(np.full((4, 4), np.nan))
+        results = reduction.Results()
+        self.assertTrue(np.isnan(results['step-mean']))
+        self.assertAlmostEqual(results['mean'], np.mean(self.clean[0]))
+
+
+if __name__ == "__main__":
+    unittest.main()
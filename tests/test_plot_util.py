@@ -0,0 +1,165 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import importlib
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from support import Stubbed
+
+# plot_util needs MPI and ADIOS at import time, but nothing tested here uses either
+stubs = Stubbed("mpi4py", "adios2", "yaml")
+plot_util = None
+
+
+def setUpModule():
+    global plot_util
+    stubs.start()
+    plot_util = importlib.import_module("plot_util")
+
+
+def tearDownModule():
+    stubs.stop()
+
+
+class PartitionTest(unittest.TestCase):
+
+    def test_balanced(self):
+        costs = {'a': 7.0, 'b': 5.0, 'c': 4.0, 'd': 3.0, 'e': 1.0}
+        parts = plot_util.Partition(costs, 2)
+        loads = sorted([sum([costs[name] for name in part]) for part in parts])
+        self.assertEqual(loads, [10.0, 10.0])
+        self.assertEqual(sorted(sum(parts, [])), sorted(costs.keys()))
+
+    def test_more_ranks_than_names(self):
+        parts = plot_util.Partition({'a': 1.0, 'b': 2.0}, 4)
+        self.assertEqual(len(parts), 4)
+        self.assertEqual(sorted([len(part) for part in parts]), [0, 0, 1, 1])
+
+    def test_equal_costs_round_robin(self):
+        parts = plot_util.Partition(dict([(str(i), 8.0) for i in range(6)]), 3)
+        self.assertEqual([len(part) for part in parts], [2, 2, 2])
+
+
+class DownsampleTest(unittest.TestCase):
+
+    def test_untouched(self):
+        data = np.arange(12.0).reshape(3, 4)
+        self.assertIs(plot_util.Downsample(data, 0), data)
+        self.assertIs(plot_util.Downsample(data, 10), data)
+
+    def test_even_blocks(self):
+        data = np.arange(16.0).reshape(4, 4)
+        self.assertTrue(np.array_equal(plot_util.Downsample(data, 2), [[2.5, 4.5], [10.5, 12.5]]))
+
+    def test_elongated(self):
+        # One factor from the long side used to floor the short side to nothing
+        data = np.random.RandomState(0).uniform(size=(4000, 20))
+        small = plot_util.Downsample(data, 100)
+        self.assertEqual(small.shape, (100, 20))
+        self.assertTrue(np.allclose(small[:, 3], data[:, 3].reshape(100, 40).mean(axis=1)))
+        self.assertEqual(plot_util.ColorImage(small, "bwr").shape, (100, 20, 4))
+
+    def test_partial_blocks_kept(self):
+        data = np.arange(35.0).reshape(5, 7)
+        small = plot_util.Downsample(data, 3)
+        self.assertEqual(small.shape, (3, 3))
+        self.assertEqual(small[0, 0], np.mean(data[:2, :3]))
+        self.assertEqual(small[-1, -1], data[4, 6])
+        self.assertEqual(small[-1, 0], np.mean(data[4, :3]))
+        self.assertAlmostEqual(np.sum(small * np.outer([2, 2, 1], [3, 3, 1])), np.sum(data))
+
+
+class MinMaxTest(unittest.TestCase):
+
+    def Plotter(self, minmax, colorscale="step"):
+        plotter = object.__new__(plot_util.KittiePlotter)
+        plotter.minmax = minmax
+        plotter.colorscale = colorscale
+        plotter.allx = True
+        plotter.DimInfo = {'xname': 'x'}
+        plotter.uMatches = ['u', 'x']
+        plotter.GlobalMinMax = {}
+        return plotter
+
+    def Step(self, plotter, scale):
+        data = {'minmax': {}, 'x': np.arange(4.0), 'u': scale * np.array([-1.0, 0.5, np.nan, 2.0])}
+        plotter._MinMax(data)
+        return data['minmax']
+
+    def test_not_asked(self):
+        self.assertEqual(self.Step(self.Plotter(False), 1.0), {})
+
+    def test_step(self):
+        plotter = self.Plotter(True)
+        self.assertEqual(self.Step(plotter, 1.0), {'u': {'min': -1.0, 'max': 2.0}})
+        self.assertEqual(self.Step(plotter, 0.5), {'u': {'min': -0.5, 'max': 1.0}})
+
+    def test_global(self):
+        plotter = self.Plotter(True, colorscale="global")
+        self.Step(plotter, 3.0)
+        self.assertEqual(self.Step(plotter, 0.5), {'u': {'min': -3.0, 'max': 6.0}})
+
+
+class FakeIndex(object):
+    """ md.idx of a writer that's written ahead more steps every time it's looked at """
+
+    def __init__(self, counts):
+        self.counts = list(counts)
+        self.refreshes = 0
+
+    def Refresh(self):
+        self.refreshes += 1
+        return self.counts.pop(0)
+
+
+class SkipTest(unittest.TestCase):
+
+    def Plotter(self, counts=None, latest=True, stride=1):
+        plotter = object.__new__(plot_util.KittiePlotter)
+        plotter.ReadComm = mock.Mock()
+        plotter.ReadComm.Get_rank.return_value = 0
+        plotter.ReadComm.bcast.side_effect = lambda value, root=0: value
+        plotter.latest = latest
+        plotter.stride = stride
+        plotter.LastRendered = None
+        plotter.SkipTarget = -1
+        plotter.index = None
+        if counts is not None:
+            plotter.index = FakeIndex(counts)
+        return plotter
+
+    def Drawn(self, plotter, steps):
+        return [step for step in range(steps) if not plotter._Skip(step)]
+
+    def test_writer_ahead(self):
+        # Each time md.idx is read the writer is a few steps further along
+        plotter = self.Plotter(counts=[5, 10, 15, 20])
+        self.assertEqual(self.Drawn(plotter, 20), [4, 9, 14, 19])
+        self.assertEqual(plotter.index.refreshes, 4)
+
+    def test_caught_up(self):
+        plotter = self.Plotter(counts=list(range(1, 11)))
+        self.assertEqual(self.Drawn(plotter, 10), list(range(10)))
+
+    def test_stride(self):
+        plotter = self.Plotter(latest=False, stride=3)
+        self.assertEqual(self.Drawn(plotter, 10), [0, 3, 6, 9])
+        self.assertIsNone(plotter.index)
+
+    def test_no_index(self):
+        plotter = self.Plotter(latest=True)
+        with mock.patch.object(plot_util.KittiePlotter, "_IndexFile", return_value=None):
+            self.assertEqual(self.Drawn(plotter, 5), list(range(5)))
+        self.assertFalse(plotter.index)
+
+    def test_not_root(self):
+        plotter = self.Plotter(counts=[])
+        plotter.ReadComm.Get_rank.return_value = 1
+        plotter.ReadComm.bcast.side_effect = lambda value, root=0: True
+        self.assertTrue(plotter._Skip(0))
+        self.assertIsNone(plotter.LastRendered)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import os
+import shutil
+import tempfile
+import importlib.util
+import unittest
+
+import numpy as np
+
+from support import Stubbed, top
+
+# matplotlib stays loaded after the stubs are gone, like numpy
+try:
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot
+    import matplotlib.tri
+    import matplotlib.gridspec
+    import matplotlib.ticker
+except ImportError:
+    matplotlib = None
+
+stubs = Stubbed("mpi4py", "adios2", "yaml")
+triangular = None
+colormap = None
+
+
+def Load(name, filename):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(top, "plot", filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def setUpModule():
+    global triangular, colormap
+    if matplotlib is None:
+        return
+    stubs.start()
+    triangular = Load("plotter_2d_triangular", "plotter-2d-triangular.py")
+    colormap = Load("plotter_2d", "plotter-2d.py")
+
+
+def tearDownModule():
+    if matplotlib is not None:
+        stubs.stop()
+
+
+@unittest.skipIf(matplotlib is None, "needs matplotlib")
+class TriangularTest(unittest.TestCase):
+
+    def setUp(self):
+        self.outdir = tempfile.mkdtemp()
+        x, y = np.meshgrid(np.linspace(0, 1, 6), np.linspace(0, 1, 5))
+        self.nodes = np.stack((x.ravel(), y.ravel()), axis=1)
+        self.triang = matplotlib.tri.Triangulation(self.nodes[:, 0], self.nodes[:, 1])
+        self.shape = np.sin(4 * self.nodes[:, 0]) * np.cos(3 * self.nodes[:, 1])
+        self.shape /= np.amax(np.abs(self.shape))
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir)
+        matplotlib.pyplot.close('all')
+        for cache in [triangular.inits, triangular.fig, triangular.ax, triangular.ColorAxis, triangular.ColorBar]:
+            cache.clear()
+
+    def Step(self, step, scale, minmax):
+        data = {'_StepNumber': np.array([step]), '_StepPhysical': np.array([0.1 * step]), 'u': scale * self.shape}
+        data['minmax'] = {'u': {'min': float(np.amin(data['u'])), 'max': float(np.amax(data['u']))}}
+        triangular.Plot(data, "nodes", "triangles", self.outdir, minmax=minmax, triang=self.triang, ext="png")
+        self.assertTrue(os.path.exists(os.path.join(self.outdir, "u_vs_x_y-{0}.png".format(step))))
+        return triangular.ColorBar['u']
+
+    def Check(self, minmax):
+        self.Step(0, 1.0, minmax)
+        bar = self.Step(1, 10.0, minmax)
+        low, high = bar.ax.get_ylim()
+        self.assertAlmostEqual(low, -10.0, delta=0.5)
+        self.assertAlmostEqual(high, 10.0, delta=0.5)
+        return bar
+
+    def test_colorbar_follows_range(self):
+        ticks = self.Check(True).get_ticks()
+        self.assertAlmostEqual(ticks[0], -10.0, places=3)
+        self.assertAlmostEqual(ticks[-1], 10.0, places=3)
+
+    def test_colorbar_follows_levels(self):
+        self.Check(False)
+
+
+@unittest.skipIf(matplotlib is None, "needs matplotlib")
+class LimitsTest(unittest.TestCase):
+
+    def test_global(self):
+        self.assertEqual(colormap.Limits({'min': -1.0, 'max': 3.0}), (-1.0, 3.0))
+
+    def test_symmetric(self):
+        low, high = colormap.Limits({'min': -1.0, 'max': 3.0}, symmetric=True)
+        self.assertAlmostEqual(low, -3.0)
+        self.assertAlmostEqual(high, 3.0)
+
+    def test_flat(self):
+        low, high = colormap.Limits({'min': 2.0, 'max': 2.0})
+        self.assertLess(low, high)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -23,6 +23,7 @@ import subprocess
 import sys
 import getpass
 import yaml
+import json
 
 import collections
 from collections import OrderedDict
@@ -506,11 +507,17 @@ class KittieJob(cheetah.Campaign):
                     self.codesetup[codename][self.keywords['args']] += [self.codesetup[codename]["match-dimensions"]]
                 if "data" in self.codesetup[codename]:
                     self.codesetup[codename]['.plotter'] = {'plots': self.codesetup[codename]["data"]}
+                for key in ['rebalance', 'weights', 'pipeline', 'latest', 'stride', 'wait', 'colorscale']:
+                    if key in self.codesetup[codename]:
+                        self.codesetup[codename].setdefault('.plotter', {})[key] = self.codesetup[codename][key]
 
                 if 'colortype' in self.codesetup[codename]:
                     self.codesetup[codename][self.keywords['options']]["colormap"] = self.codesetup[codename]["colortype"]
                 if 'viewtype' in self.codesetup[codename]:
                     self.codesetup[codename][self.keywords['options']]["type"] = self.codesetup[codename]["viewtype"]
+                for key in ['ext', 'raster', 'resolution']:
+                    if key in self.codesetup[codename]:
+                        self.codesetup[codename][self.keywords['options']][key] = self.codesetup[codename][key]
 
                 if ('use' in self.config[self.keywords['dashboard']]) and (self.config[self.keywords['dashboard']]['use']):
                     self.codesetup[codename][self.keywords['options']]['use-dashboard'] = 'on'
@@ -524,8 +531,13 @@ class KittieJob(cheetah.Campaign):
                     self.codesetup[codename][self.keywords['args']] += [self.codesetup[codename]['x']]
                 if "y" in self.codesetup[codename]:
                     self.codesetup[codename][self.keywords['options']]['y'] = self.codesetup[codename]['y']
+                if "ext" in self.codesetup[codename]:
+                    self.codesetup[codename][self.keywords['options']]['ext'] = self.codesetup[codename]['ext']
                 if "data" in self.codesetup[codename]:
                     self.codesetup[codename]['.plotter'] = {'plots': self.codesetup[codename]["data"]}
+                for key in ['rebalance', 'weights', 'pipeline', 'latest', 'stride', 'wait', 'colorscale']:
+                    if key in self.codesetup[codename]:
+                        self.codesetup[codename].setdefault('.plotter', {})[key] = self.codesetup[codename][key]
 
                 if ('use' in self.config[self.keywords['dashboard']]) and (self.config[self.keywords['dashboard']]['use']):
                     self.codesetup[codename][self.keywords['options']]['use-dashboard'] = 'on'
@@ -965,6 +977,11 @@ class KittieJob(cheetah.Campaign):
             with open(outname, "w") as outfile:
                 outfile.write(outstr)
 
+            # Same thing, but loads at startup without PyYAML
+            outname = os.path.join(outdir, ".kittie-groups-{0}.json".format(k))
+            with open(outname, "w") as outfile:
+                json.dump(self.codesetup[codename]['groups'], outfile, separators=(',', ':'))
+
         if "monitors" in self.codenames:
             codename = "monitors"
             if self.launchmode == "default":
@@ -1007,6 +1024,9 @@ class KittieJob(cheetah.Campaign):
             outname = os.path.join(outdir, ".kittie-codenames-{0}.yaml".format(i))
             with open(outname, 'w') as outfile:
                 outfile.write(outstr)
+            outname = os.path.join(outdir, ".kittie-codenames-{0}.json".format(i))
+            with open(outname, 'w') as outfile:
+                json.dump(outdict, outfile, separators=(',', ':'))
 
 
     def WriteStepsFile(self):
@@ -4,9 +4,30 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import os
-import numpy as np
+import importlib
 
 
+class LazyModule(object):
+    """ Stands in for a module, which only gets imported the first time one of its attributes is used """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _Load(self):
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._Load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._Load(), attr, value)
+
+
+np = LazyModule("numpy")
+
 
 def GetType(varid):
     size = varid.Sizeof()
@@ -28,6 +49,31 @@ def GetType(varid):
     return UserType
 
 
+class BufferPool(object):
+    """
+    Arrays to read into, reused step after step, and only reallocated when a variable's shape (or type) changes.
+    With more than one slot, successive reads of a variable cycle through different arrays,
+    so the next step can be read while the previous step's arrays are still in use.
+    """
+
+    def __init__(self, slots=1):
+        self.slots = slots
+        self.arrays = {}
+        self.next = {}
+
+
+    def Get(self, key, shape, dtype):
+        shape = tuple(shape)
+        dtype = np.dtype(dtype)
+        if (key not in self.arrays) or (self.arrays[key][0].shape != shape) or (self.arrays[key][0].dtype != dtype):
+            self.arrays[key] = [np.empty(shape, dtype=dtype) for i in range(self.slots)]
+            self.next[key] = 0
+
+        i = self.next[key]
+        self.next[key] = (i + 1) % self.slots
+        return self.arrays[key][i]
+
+
 def DotSplit(txt):
     if txt[0] == '{':
         EndIndex = '}'
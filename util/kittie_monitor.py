@@ -3,15 +3,26 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 import yaml
 import re
-import importlib.util
+import ast
 import sys
 import os
+import collections
+import math
+import pickle
+import types
+import multiprocessing
+import concurrent.futures
 
 if 'ADIOS' in os.environ:
     sys.path.insert(0, os.environ['ADIOS'])
 
-import adios2
-import numpy as np
+# A spawned worker re-imports this file (as __mp_main__) before running anything, so nothing here may load ADIOS up front:
+# an MPI build of it would initialize MPI in every worker
+from kittie_common import LazyModule
+from kittie_workers import LoadModule, WorkerInit, WorkerCall, Lookup
+adios2 = LazyModule("adios2")
+np = LazyModule("numpy")
+kittie_reductions = LazyModule("kittie_reductions")
 
 
 def GetArgumentList(text):
@@ -22,11 +33,13 @@ def GetArgumentList(text):
     opened = 0
     start = 0
     for i in range(len(astr)):
-        if astr[i] == '(':
+        if astr[i] in '([':
             opened += 1
         elif (astr[i] == ',') and (opened == 0):
             alist += [astr[start:i].strip()]
             start = i + 1
+        elif astr[i] == ']':
+            opened -= 1
         elif astr[i] == ')':
             if (opened == 0):
                 alist += [astr[start:i].strip()]
@@ -36,6 +49,108 @@ def GetArgumentList(text):
     return alist
 
 
+def Resolve(name):
+    """ Look up a (dotted) name in the user's module, or failing that, in here (e.g. np.pi) """
+    parts = name.split('.')
+    if hasattr(MonitorGlobal.module, parts[0]):
+        obj = getattr(MonitorGlobal.module, parts[0])
+    elif parts[0] in globals():
+        obj = globals()[parts[0]]
+    else:
+        raise ValueError("Can't find {0} for the monitor".format(name))
+    for part in parts[1:]:
+        obj = getattr(obj, part)
+    return obj
+
+
+def ImportPath(name):
+    """
+    Where a worker process finds what Resolve found: (None, name) in the user's module, which each worker loads itself,
+    or (module, attribute path) for the modules in here (e.g. np.mean is ('numpy', 'mean')), which the worker imports
+    """
+    parts = name.split('.')
+    if hasattr(MonitorGlobal.module, parts[0]):
+        return None, name
+
+    obj = globals().get(parts[0], None)
+    if isinstance(obj, LazyModule):
+        module = obj._name
+    elif isinstance(obj, types.ModuleType):
+        module = obj.__name__
+    else:
+        raise ValueError("{0} can't run in a worker process: it has to be in the monitor's module, or in a module".format(name))
+    return module, '.'.join(parts[1:])
+
+
+def Keyword(text):
+    """ name=value arguments; (None, text) for everything else """
+    match = re.match(r"^([A-Za-z_]\w*)\s*=(?!=)(.*)$", text, re.DOTALL)
+    if match is None:
+        return None, text
+    return match.group(1), match.group(2).strip()
+
+
+def Constant(text):
+    """ Non-stream arguments are Python literals, or names to look up """
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return Resolve(text)
+
+
+def SplitSelection(text):
+    """
+    var[10:20, :]@4 -> ('var', ['10:20', ':'], 4): the variable, the slice in each dimension, and to only read every 4th step.
+    Both parts are optional.
+    """
+
+    stride = 1
+    if text.find('@') != -1:
+        text, stride = text.rsplit('@', 1)
+        stride = int(stride)
+        if stride < 1:
+            raise ValueError("Step stride needs to be positive: {0}".format(stride))
+    text = text.strip()
+
+    dims = None
+    if text.endswith(']'):
+        start = text.find('[')
+        dims = [dim.strip() for dim in text[start+1:-1].split(',')]
+        text = text[:start].strip()
+
+    return text, dims, stride
+
+
+def SelectionBox(shape, dims):
+    """ ADIOS starts and counts for the slices, plus the shape to hand out, with integer-indexed dimensions dropped like numpy would """
+
+    starts = np.zeros(len(shape), dtype=np.int64)
+    counts = np.array(shape, dtype=np.int64)
+    outshape = []
+
+    for i, size in enumerate(shape):
+        if (dims is None) or (i >= len(dims)) or (dims[i] == ':'):
+            outshape += [size]
+            continue
+
+        if dims[i].find(':') != -1:
+            parts = dims[i].split(':')
+            if len(parts) > 2:
+                raise ValueError("Slices with steps aren't supported: {0}".format(dims[i]))
+            start, stop, step = slice(*[int(part) if part.strip() else None for part in parts]).indices(size)
+            starts[i] = start
+            counts[i] = max(stop - start, 0)
+            outshape += [counts[i]]
+        else:
+            index = int(dims[i])
+            if index < 0:
+                index += size
+            starts[i] = index
+            counts[i] = 1
+
+    return starts, counts, tuple(outshape)
+
+
 class MonitorGlobal:
     module = None
     setup = {}
@@ -49,16 +164,34 @@ class SpecialArg(object):
 
 class IOSetup(object):
 
-    def __init__(self, name, filename, code):
+    StreamEngines = ["sst", "ssc", "dataman", "insitumpi"]
+
+    def __init__(self, name, filename, code, engine=None):
         self.code = code
         self.name = name
         self.filename = filename
         self.variables = []
+        self.selections = {}
+        self.queue = collections.deque()
+        self.stride = 1
+        self.steps = 0
         self.data = {}
         self.open = False
         self.found = False
         self.complete = False
 
+        if isinstance(engine, dict):
+            engine = engine.get('name', None)
+        self.streaming = (engine is not None) and (str(engine).lower() in self.StreamEngines)
+
+
+    @property
+    def WatchPath(self):
+        # BP files show new steps by appending to md.idx; streams have nothing to watch
+        if self.streaming or (self.filename is None):
+            return None
+        return os.path.join(self.filename, 'md.idx')
+
 
 class UserMonitor(object):
 
@@ -67,16 +200,74 @@ class UserMonitor(object):
             #@effis-begin group->group
             self.IOSetups[group].io = adios.DeclareIO(group)
             #@effis-end
+        if self.reduction:
+            self.func.Declare(adios, self.name)
 
 
     def DoFunction(self):
-        args = []
-        for arg in self.args:
-            if type(arg) == SpecialArg:
-                args += [self.IOSetups[arg.groupname].data[arg.varname]]
+        # Constants were filled in once by ParseArgs; only the stream slots change
+        for i, arg in self.slots:
+            self.args[i] = self.IOSetups[arg.groupname].data[arg.varname]
+
+        if self.parallel and (self.workers is not None):
+            self.Dispatch(self.args)
+        else:
+            self.func(*self.args, **self.kwargs)
+
+
+    def Dispatch(self, args):
+        """ Copy the arrays into shared memory and hand the call to the worker pool, with at most MaxInFlight calls outstanding """
+        from multiprocessing import shared_memory
+
+        self.Reap(limit=self.MaxInFlight - 1)
+
+        # Each in-flight call has its own slot of segments, kept from call to call and only remade when an array outgrows one.
+        # At most MaxInFlight - 1 calls are left after the Reap, and they're reaped oldest first, so this slot's last call is done.
+        slot = self.NextSlot
+        self.NextSlot = (self.NextSlot + 1) % self.MaxInFlight
+
+        shared = []
+        for i, arg in enumerate(args):
+            if isinstance(arg, np.ndarray):
+                key = (slot, i)
+                if (key in self.segments) and (self.segments[key].size < arg.nbytes):
+                    self.segments[key].close()
+                    self.segments[key].unlink()
+                    del self.segments[key]
+                if key not in self.segments:
+                    self.segments[key] = shared_memory.SharedMemory(create=True, size=max(arg.nbytes, 1))
+                view = np.ndarray(arg.shape, dtype=arg.dtype, buffer=self.segments[key].buf)
+                view[...] = arg
+                del view
+                shared += [(True, (self.segments[key].name, arg.shape, arg.dtype.str))]
             else:
-                args += [arg]
-        self.func(*args)
+                shared += [(False, arg)]
+
+        future = self.workers.submit(WorkerCall, self.target, shared, self.kwargs)
+        self.inflight.append(future)
+
+
+    def Reap(self, limit=None):
+        """ Clean up finished calls, waiting on the oldest ones until no more than limit are left (finish everything for None) """
+        if limit is None:
+            limit = 0
+        while len(self.inflight) > 0:
+            future = self.inflight[0]
+            if (not future.done()) and (len(self.inflight) <= limit):
+                break
+            self.inflight.popleft()
+            future.result()
+
+
+    def Release(self):
+        """ Finish every call, then give back the shared memory """
+        try:
+            self.Reap()
+        finally:
+            for key in self.segments:
+                self.segments[key].close()
+                self.segments[key].unlink()
+            self.segments = {}
 
 
     def Open(self):
@@ -92,7 +283,8 @@ class UserMonitor(object):
                     pass
                 else:
                     self.IOSetups[group].open = True
-                    
+                    self.progress = True
+
             if self.IOSetups[group].open:
                 opened += 1
 
@@ -100,31 +292,108 @@ class UserMonitor(object):
             self.AllOpen = True
 
 
-    def Loop(self):
+    def Read(self, groupname):
+        """ Issue the Gets for the current step, into pooled buffers """
+        data = {}
+        for key in self.IOSetups[groupname].variables:
+            varname, dims = self.IOSetups[groupname].selections[key]
+            varid = self.IOSetups[groupname].io.InquireVariable(varname)
+            starts, counts, outshape = SelectionBox(varid.Shape(), dims)
+            dtype = kittie.kittie_common.GetType(varid)
+            buffer = self.pool.Get((groupname, key), counts, dtype)
+            varid.SetSelection([starts, counts])
+            self.IOSetups[groupname].engine.Get(varid, buffer)
+            data[key] = buffer.reshape(outshape)
+        return data
+
+
+    def Join(self):
+        """
+        Call the function for each step every stream has, oldest first.
+        Steps a stream has that another stream has already moved past are never going to match, so they're dropped.
+        """
+        queues = [self.IOSetups[group].queue for group in self.IOSetups]
+        while all([len(queue) > 0 for queue in queues]):
+            target = max([queue[0][0] for queue in queues])
+            for queue in queues:
+                while (len(queue) > 0) and (queue[0][0] < target):
+                    queue.popleft()
+            if not all([(len(queue) > 0) and (queue[0][0] == target) for queue in queues]):
+                continue
+            for group in self.IOSetups:
+                self.IOSetups[group].data = self.IOSetups[group].queue.popleft()[1]
+            self.DoFunction()
+
+        # Once a stream has ended with nothing left buffered, nothing else can match: let the others drain to their ends
+        for group in self.complete:
+            if len(self.IOSetups[group].queue) == 0:
+                for queue in queues:
+                    queue.clear()
+                break
+
+
+    @property
+    def Streaming(self):
+        return all([self.IOSetups[group].streaming for group in self.IOSetups])
+
+
+    def Loop(self, timeout=0.0):
+        # progress says if anything happened, so the scheduler knows whether to back off
+        self.progress = False
+        if len(self.inflight) > 0:
+            self.Reap(limit=self.MaxInFlight)
+
         if not self.AllOpen:
             self.Open()
         elif not self.finished:
+            fresh = False
             for groupname in self.IOSetups:
+                # A stream that's already buffered as far ahead as allowed waits for the others to catch up
+                if self.align and (len(self.IOSetups[groupname].queue) >= self.AlignDepth):
+                    continue
+                if self.IOSetups[groupname].streaming:
+                    wait = timeout
+                else:
+                    wait = 0.0
                 #@effis-begin self.IOSetups[groupname].engine--->groupname
-                status = self.IOSetups[groupname].engine.BeginStep(kittie.Kittie.ReadStepMode, 0.0)
+                status = self.IOSetups[groupname].engine.BeginStep(kittie.Kittie.ReadStepMode, wait)
                 if status == adios2.StepStatus.OK:
-                    for varname in self.IOSetups[groupname].variables:
-                        varid = self.IOSetups[groupname].io.InquireVariable(varname)
-                        shape = varid.Shape()
-                        dtype = kittie.kittie_common.GetType(varid)
-                        self.IOSetups[groupname].data[varname] = np.zeros(tuple(shape), dtype=dtype)
-                        starts = np.zeros(len(shape), dtype=np.int64)
-                        counts = np.array(shape, dtype=np.int64)
-                        varid.SetSelection([starts, counts])
-                        self.IOSetups[groupname].engine.Get(varid, self.IOSetups[groupname].data[varname])
+                    self.progress = True
+                    self.IOSetups[groupname].steps += 1
+
+                    # Steps off the stride are let go without reading anything
+                    read = ((self.IOSetups[groupname].steps - 1) % self.IOSetups[groupname].stride == 0)
+                    if read:
+                        data = self.Read(groupname)
+                        StepNumber = None
+                        if self.align:
+                            varid = self.IOSetups[groupname].io.InquireVariable("_StepNumber")
+                            if varid is not None:
+                                StepNumber = self.pool.Get((groupname, "_StepNumber"), [1], kittie.kittie_common.GetType(varid))
+                                self.IOSetups[groupname].engine.Get(varid, StepNumber)
+
                     self.IOSetups[groupname].engine.EndStep()
-                    self.IOSetups[groupname].found = True
+
+                    if read and self.align:
+                        # Streams without _StepNumber are matched up by how many steps they've had
+                        if StepNumber is None:
+                            StepNumber = self.IOSetups[groupname].steps - 1
+                        else:
+                            StepNumber = int(StepNumber[0])
+                        self.IOSetups[groupname].queue.append((StepNumber, data))
+                    elif read:
+                        self.IOSetups[groupname].data = data
+                        self.IOSetups[groupname].found = True
+                        fresh = True
                 elif status == adios2.StepStatus.EndOfStream:
                     if groupname not in self.complete:
                         self.complete += [groupname]
+                        self.progress = True
                 #@effis-end
 
-            if self.IOSetups[groupname].found and (status == adios2.StepStatus.OK):
+            if self.align:
+                self.Join()
+            elif fresh and all([self.IOSetups[group].found for group in self.IOSetups]):
                 self.DoFunction()
 
             if len(self.complete) == len(self.IOSetups):
@@ -133,6 +402,8 @@ class UserMonitor(object):
                     #@effis-begin self.IOSetups[groupname].engine--->groupname
                     self.IOSetups[groupname].engine.Close()
                     #@effis-end
+                if self.reduction:
+                    self.func.Close()
 
         if self.finished:
             return False
@@ -148,12 +419,20 @@ class UserMonitor(object):
 
         else:
             fname = match.group(1).strip()
-            estr = "self.func = MonitorGlobal.module.{0}".format(fname)
-            exec(estr)
+            self.fname = fname
             argstr = match.group(2).strip()
-            self.args = GetArgumentList(argstr)
-
-            for i, arg in enumerate(self.args):
+            self.args = []
+            self.kwargs = {}
+            self.slots = []
+
+            for arg in GetArgumentList(argstr):
+                keyword, value = Keyword(arg)
+                if keyword is not None:
+                    self.kwargs[keyword] = Constant(value)
+                    continue
+
+                i = len(self.args)
+                self.args += [None]
                 special = False
 
                 for code in MonitorGlobal.setup:
@@ -162,40 +441,147 @@ class UserMonitor(object):
                         special = True
                         code, arg = kittie.kittie_common.DotSplit(arg)
                         groupname, varname = kittie.kittie_common.DotSplit(arg)
+                        varname, dims, stride = SplitSelection(varname)
+                        if dims is None:
+                            key = varname
+                        else:
+                            key = "{0}[{1}]".format(varname, ', '.join(dims))
                         filename = MonitorGlobal.setup[code][groupname]['filename']
 
                         SetupName = "{0}-{1}".format(code, groupname)
                         if SetupName not in self.IOSetups:
-                            self.IOSetups[SetupName] = IOSetup(groupname, filename, code)
+                            engine = MonitorGlobal.setup[code][groupname].get('engine', None)
+                            self.IOSetups[SetupName] = IOSetup(groupname, filename, code, engine=engine)
                             if SetupName not in kittie.Kittie.YamlEngineSettings:
                                 kittie.Kittie.YamlEngineSettings[SetupName] = MonitorGlobal.setup[code][groupname]
-                        if varname not in self.IOSetups[SetupName].variables:
-                            self.IOSetups[SetupName].variables += [varname]
+                        if key not in self.IOSetups[SetupName].variables:
+                            self.IOSetups[SetupName].variables += [key]
+                            self.IOSetups[SetupName].selections[key] = (varname, dims)
+
+                        # A stream read by arguments with different strides is read every least common multiple of them
+                        current = self.IOSetups[SetupName].stride
+                        self.IOSetups[SetupName].stride = current * stride // math.gcd(current, stride)
 
-                        self.args[i] = SpecialArg(SetupName, varname)
+                        self.slots += [(i, SpecialArg(SetupName, key))]
+                        self.args[i] = None
                         break
 
                 if not special:
-                    exec("self.args[i] = {0}".format(arg))
+                    self.args[i] = Constant(arg)
+
+            # Names the user's module doesn't have can be one of the built-in reductions, which take the keywords when they're made
+            self.reduction = False
+            if (not hasattr(MonitorGlobal.module, fname.split('.')[0])) and (fname in kittie_reductions.Reductions):
+                if (len(self.args) != 1) or (len(self.slots) != 1):
+                    raise ValueError("Reduction {0} takes exactly one variable to read, got: {1}".format(fname, argstr))
+                self.func = kittie_reductions.Reductions[fname](**self.kwargs)
+                self.kwargs = {}
+                self.reduction = True
+            else:
+                self.func = Resolve(fname)
 
 
-    def __init__(self, name, TxtCmd):
+    def __init__(self, name, TxtCmd, slots=1):
         self.ArgsSearch = re.compile("(.*)(\(.*\))")
+
+        # Calls are either just the text, or a dictionary with the text as call and per-monitor options
+        options = {}
+        if isinstance(TxtCmd, dict):
+            options = TxtCmd
+            TxtCmd = options['call']
+        self.parallel = bool(options.get('parallel', False))
+        self.MaxInFlight = max(int(options.get('max-in-flight', 2)), 1)
+
+        # align: only call with data from the same step of every stream, holding up to align-depth steps per stream while waiting
+        self.align = bool(options.get('align', False))
+        self.AlignDepth = max(int(options.get('align-depth', 4)), 1)
+        if self.align:
+            slots = max(slots, self.AlignDepth + 2)
+        self.workers = None
+        self.inflight = collections.deque()
+        self.segments = {}
+        self.NextSlot = 0
+
+        self.pool = kittie.kittie_common.BufferPool(slots=slots)
         self.complete = []
         self.finished = False
+        self.progress = False
         self.AllOpen = False
         self.name = name
         self.IOSetups = {}
         self.ParseArgs(TxtCmd)
 
+        # Reductions keep their state between calls, so they can't be spread over worker processes
+        if self.reduction:
+            self.parallel = False
+        if self.parallel:
+            self.WorkerTarget()
+
+
+    def WorkerTarget(self):
+        """ Check now, not on the first step, that the workers can find the function and be sent what it's called with """
+        self.target = ImportPath(self.fname)
+        if self.target[0] is not None:
+            Lookup(self.target)
+        constants = [arg for i, arg in enumerate(self.args) if i not in [slot[0] for slot in self.slots]]
+        try:
+            pickle.dumps((self.target, constants, self.kwargs))
+        except Exception as e:
+            raise ValueError("{0} can't run in a worker process, its arguments can't be pickled: {1}".format(self.name, e))
+
 
 class UserMonitors(object):
 
+    def Watch(self, waiter):
+        for key in self.monitors:
+            for group in self.monitors[key].IOSetups:
+                path = self.monitors[key].IOSetups[group].WatchPath
+                if path is not None:
+                    waiter.Watch(path)
+
+
     def Loop(self):
-        status = np.ones(len(self.monitors), dtype=np.bool_)
-        while np.all(status):
-            for i, key in enumerate(self.monitors.keys()):
-                status[i] = self.monitors[key].Loop()
+        """
+        Go around the monitors, starting one further along each pass so none of them always goes first.
+        When a whole pass finds nothing new, back off: sleep until a watched file changes (or the backoff interval passes),
+        or if everything is streaming, block in BeginStep for that long instead.
+        """
+
+        waiter = kittie.WaitStrategy(self.wait)
+        streaming = all([self.monitors[key].Streaming for key in self.monitors])
+        names = list(self.monitors.keys())
+        first = 0
+        timeout = 0.0
+
+        while True:
+            progress = False
+            running = 0
+
+            for i in range(len(names)):
+                monitor = self.monitors[names[(first + i) % len(names)]]
+                if monitor.finished:
+                    continue
+                if monitor.Loop(timeout=timeout):
+                    running += 1
+                progress = progress or monitor.progress
+
+            if running == 0:
+                for key in self.monitors:
+                    self.monitors[key].Release()
+                if self.workers is not None:
+                    self.workers.shutdown(wait=True)
+                break
+            first = (first + 1) % len(names)
+
+            if progress:
+                waiter.Reset()
+                timeout = 0.0
+            elif streaming:
+                timeout = waiter.interval
+                waiter.Backoff()
+            else:
+                self.Watch(waiter)
+                waiter.Sleep()
 
 
     def __init__(self, configfile=None, groupsfile=None):
@@ -210,14 +596,29 @@ class UserMonitors(object):
             configfile = "monitor-config.yaml"
         with open(configfile, 'r') as ystream:
             config = yaml.load(ystream)
+        self.wait = config.get('wait', None)
+
+        # Monitors that only use the built-in reductions don't need a module of their own
+        if 'filename' in config:
+            MonitorGlobal.module = LoadModule(config['filename'])
 
-        spec = importlib.util.spec_from_file_location("module.name", config['filename'])
-        MonitorGlobal.module = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(MonitorGlobal.module)
+        # double-buffer: read the next step into different arrays than the ones the last call got
+        slots = 1
+        if ('double-buffer' in config) and config['double-buffer']:
+            slots = 2
 
         calls = config['calls']
         for name in calls:
-            self.monitors[name] = UserMonitor(name, calls[name])
+            self.monitors[name] = UserMonitor(name, calls[name], slots=slots)
+
+        # Monitors with parallel: true run in a pool of spawned worker processes. They only run kittie_workers,
+        # which imports numpy and nothing else, and this file keeps ADIOS lazy for when they re-import it.
+        self.workers = None
+        if any([self.monitors[name].parallel for name in self.monitors]):
+            context = multiprocessing.get_context("spawn")
+            self.workers = concurrent.futures.ProcessPoolExecutor(max_workers=config.get('workers', None), mp_context=context, initializer=WorkerInit, initargs=(config.get('filename', None),))
+            for name in self.monitors:
+                self.monitors[name].workers = self.workers
 
 
 if __name__ == "__main__":
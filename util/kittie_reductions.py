@@ -0,0 +1,315 @@
+"""
+Streaming reductions that kittie_monitor can call by name, e.g. in monitor-config.yaml:
+
+    calls:
+      density-stats: welford(xgc.diagnosis.density)
+      density-hist: histogram(xgc.diagnosis.density, bins=128)
+
+Each one keeps a fixed amount of state across steps, and writes what it has after every step
+to <monitor name>.bp, so a health check doesn't need to ship whole fields anywhere.
+Keyword arguments in the call go to the constructor.
+NaNs and infs are left out of every reduction, and counted in nan-count (this step) and nan-total (all steps).
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+import abc
+import collections
+import warnings
+
+import adios2
+import numpy as np
+
+
+class Reduction(abc.ABC):
+    """ Subclasses say how to fold in a step (Update) and what to write out (Results); this does the writing """
+
+    def __init__(self):
+        self.io = None
+        self.engine = None
+        self.variables = {}
+        self.steps = 0
+        self.nans = 0
+        self.NanTotal = 0
+
+
+    @abc.abstractmethod
+    def Update(self, data):
+        pass
+
+
+    @abc.abstractmethod
+    def Results(self):
+        """ OrderedDict of name -> array of what to write this step """
+        pass
+
+
+    def __call__(self, data):
+        data = np.asarray(data)
+        self.nans = data.size - np.count_nonzero(np.isfinite(data))
+        self.NanTotal += self.nans
+        self.Update(data)
+        self.steps += 1
+        if self.io is not None:
+            self.Write()
+
+
+    @staticmethod
+    def Finite(data):
+        """ Every finite value, flattened """
+        data = data.ravel()
+        return data[np.isfinite(data)]
+
+
+    def Declare(self, adios, name):
+        self.io = adios.DeclareIO("{0}-reduction".format(name))
+        self.filename = "{0}.bp".format(name)
+
+
+    def Write(self):
+        results = self.Results()
+        results['steps'] = self.steps
+        results['nan-count'] = self.nans
+        results['nan-total'] = self.NanTotal
+
+        # Deferred Puts need their arrays to stay put until EndStep
+        arrays = []
+        if self.engine is None:
+            self.engine = self.io.Open(self.filename, adios2.Mode.Write)
+        self.engine.BeginStep()
+
+        for name in results:
+            value = np.atleast_1d(np.asarray(results[name]))
+            shape = list(value.shape)
+            if name not in self.variables:
+                self.variables[name] = self.io.DefineVariable(name, value, shape, [0]*value.ndim, shape)
+            elif self.variables[name].Shape() != shape:
+                self.variables[name].SetShape(shape)
+                self.variables[name].SetSelection([[0]*value.ndim, shape])
+            self.engine.Put(self.variables[name], value)
+            arrays += [value]
+
+        self.engine.EndStep()
+
+
+    def Close(self):
+        if self.engine is not None:
+            self.engine.Close()
+            self.engine = None
+
+
+class Welford(Reduction):
+    """ min/max/mean/variance over every element of every step so far, plus the same for the latest step """
+
+    def __init__(self):
+        super(Welford, self).__init__()
+        self.count = 0
+        self.mean = 0.0
+        self.M2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.last = None
+
+
+    def Update(self, data):
+        data = self.Finite(data)
+        n = data.shape[0]
+        if n == 0:
+            self.last = (np.nan, np.nan, np.nan, np.nan)
+            return
+
+        mean = np.mean(data)
+        M2 = np.sum((data - mean)**2)
+        low = np.amin(data)
+        high = np.amax(data)
+        self.last = (low, high, mean, M2 / n)
+
+        # Chan et al. combination of the running moments with the step's
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.M2 += M2 + delta**2 * self.count * n / total
+        self.count = total
+        self.min = min(self.min, low)
+        self.max = max(self.max, high)
+
+
+    def Results(self):
+        results = collections.OrderedDict()
+        if self.last is not None:
+            results['step-min'], results['step-max'], results['step-mean'], results['step-var'] = self.last
+        results['count'] = self.count
+        results['min'] = self.min
+        results['max'] = self.max
+        results['mean'] = self.mean
+        results['var'] = self.M2 / max(self.count, 1)
+        return results
+
+
+class Histogram(Reduction):
+    """
+    Fixed bins, taken from range, or from the first step's min/max if range isn't given.
+    Values outside the bins are counted in under and over.
+    """
+
+    def __init__(self, bins=64, range=None):
+        super(Histogram, self).__init__()
+        self.bins = int(bins)
+        self.edges = None
+        if range is not None:
+            self.edges = np.linspace(range[0], range[1], self.bins + 1)
+        self.counts = np.zeros(self.bins, dtype=np.int64)
+        self.total = np.zeros(self.bins, dtype=np.int64)
+        self.under = 0
+        self.over = 0
+
+
+    def Update(self, data):
+        data = self.Finite(data)
+        if data.shape[0] == 0:
+            self.counts[:] = 0
+            return
+
+        if self.edges is None:
+            low = np.amin(data)
+            high = np.amax(data)
+            if high == low:
+                high = low + 1
+            self.edges = np.linspace(low, high, self.bins + 1)
+
+        counts, edges = np.histogram(data, bins=self.edges)
+        self.counts[:] = counts
+        self.total += self.counts
+        self.under += np.count_nonzero(data < self.edges[0])
+        self.over += np.count_nonzero(data > self.edges[-1])
+
+
+    def Results(self):
+        results = collections.OrderedDict()
+        if self.edges is not None:
+            results['edges'] = self.edges
+        results['counts'] = self.counts
+        results['total'] = self.total
+        results['under'] = self.under
+        results['over'] = self.over
+        return results
+
+
+class Norm(Reduction):
+    """ L1, L2 and max norms of each step, and the largest of each seen so far """
+
+    def __init__(self):
+        super(Norm, self).__init__()
+        self.norms = np.zeros(3)
+        self.peaks = np.zeros(3)
+
+
+    def Update(self, data):
+        data = np.abs(self.Finite(data))
+        if data.shape[0] == 0:
+            self.norms[:] = 0
+            return
+        self.norms[0] = np.sum(data)
+        self.norms[1] = np.sqrt(np.dot(data, data))
+        self.norms[2] = np.amax(data)
+        self.peaks = np.maximum(self.peaks, self.norms)
+
+
+    def Results(self):
+        results = collections.OrderedDict()
+        results['l1'], results['l2'], results['linf'] = self.norms
+        results['peak-l1'], results['peak-l2'], results['peak-linf'] = self.peaks
+        return results
+
+
+class Profile(Reduction):
+    """
+    Average over every axis but one, for each step, and the running average of that over steps.
+    Points with nothing finite to average are NaN in profile, and left out of mean-profile.
+    """
+
+    def __init__(self, axis=0):
+        super(Profile, self).__init__()
+        self.axis = int(axis)
+        self.profile = None
+        self.mean = None
+        self.n = None
+
+
+    def Update(self, data):
+        if data.ndim == 0:
+            raise ValueError("A profile needs an array to average over, not a scalar")
+        others = tuple([i for i in range(data.ndim) if i != (self.axis % data.ndim)])
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            self.profile = np.nanmean(np.where(np.isfinite(data), data, np.nan), axis=others)
+        if (self.mean is None) or (self.mean.shape != self.profile.shape):
+            self.mean = np.zeros(self.profile.shape)
+            self.n = np.zeros(self.profile.shape, dtype=np.int64)
+        valid = np.isfinite(self.profile)
+        self.n[valid] += 1
+        self.mean[valid] += (self.profile[valid] - self.mean[valid]) / self.n[valid]
+
+
+    def Results(self):
+        results = collections.OrderedDict()
+        if self.profile is not None:
+            results['profile'] = self.profile
+            results['mean-profile'] = np.where(self.n > 0, self.mean, np.nan)
+        return results
+
+
+class Percentiles(Reduction):
+    """
+    Percentiles of every value seen so far, from counts in log-spaced bins of |value| (split by sign),
+    so they're good to about one bin width (perdecade bins per factor of 10, from low to high).
+    """
+
+    def __init__(self, q=(50, 90, 99), low=1e-30, high=1e30, perdecade=10):
+        super(Percentiles, self).__init__()
+        self.q = np.atleast_1d(np.asarray(q, dtype=np.float64))
+        self.lowest = np.log10(low)
+        self.perdecade = perdecade
+        self.nbins = int(np.ceil((np.log10(high) - self.lowest) * perdecade)) + 1
+        self.positive = np.zeros(self.nbins, dtype=np.int64)
+        self.negative = np.zeros(self.nbins, dtype=np.int64)
+        self.zero = 0
+        self.count = 0
+
+
+    def Bin(self, values):
+        index = np.floor((np.log10(values) - self.lowest) * self.perdecade).astype(np.int64)
+        return np.bincount(np.clip(index, 0, self.nbins - 1), minlength=self.nbins)
+
+
+    def Update(self, data):
+        data = self.Finite(data)
+        positive = data[data > 0]
+        negative = data[data < 0]
+        self.positive += self.Bin(positive)
+        self.negative += self.Bin(-negative)
+        self.zero += data.shape[0] - positive.shape[0] - negative.shape[0]
+        self.count += data.shape[0]
+
+
+    def Results(self):
+        results = collections.OrderedDict()
+        if self.count == 0:
+            return results
+
+        # Lay the bins out in increasing value: big negatives first, then zero, then the positives
+        centers = 10.0**(self.lowest + (np.arange(self.nbins) + 0.5) / self.perdecade)
+        values = np.concatenate((-centers[::-1], [0.0], centers))
+        counts = np.concatenate((self.negative[::-1], [self.zero], self.positive))
+        index = np.searchsorted(np.cumsum(counts), self.q / 100.0 * self.count)
+        results['q'] = self.q
+        results['percentiles'] = values[np.minimum(index, values.shape[0] - 1)]
+        return results
+
+
+Reductions = {
+    'welford': Welford,
+    'histogram': Histogram,
+    'norm': Norm,
+    'profile': Profile,
+    'percentiles': Percentiles,
+}
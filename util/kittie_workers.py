@@ -0,0 +1,66 @@
+"""
+What kittie_monitor's worker processes run. Kept apart from the monitor, and importing nothing but numpy,
+so the pool's processes never load ADIOS (and with it, possibly MPI) themselves.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+import importlib
+import importlib.util
+
+import numpy as np
+
+
+class WorkerGlobal:
+    module = None
+
+
+def LoadModule(filename):
+    spec = importlib.util.spec_from_file_location("module.name", filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def WorkerInit(filename):
+    if filename is not None:
+        WorkerGlobal.module = LoadModule(filename)
+
+
+def Lookup(target):
+    """ target is (module, path): the path of attributes in an importable module, or in the user's module for None """
+    module, path = target
+    if module is None:
+        func = WorkerGlobal.module
+    else:
+        func = importlib.import_module(module)
+    for part in path.split('.'):
+        if part:
+            func = getattr(func, part)
+    return func
+
+
+def WorkerCall(target, args, kwargs=None):
+    """ Arrays arrive as (name, shape, dtype) of shared memory blocks, which are only viewed, never copied """
+    from multiprocessing import shared_memory
+
+    if kwargs is None:
+        kwargs = {}
+
+    func = Lookup(target)
+
+    blocks = []
+    values = []
+    for shared, value in args:
+        if shared:
+            name, shape, dtype = value
+            blocks += [shared_memory.SharedMemory(name=name)]
+            values += [np.ndarray(shape, dtype=dtype, buffer=blocks[-1].buf)]
+        else:
+            values += [value]
+
+    try:
+        func(*values, **kwargs)
+    finally:
+        del values
+        for block in blocks:
+            block.close()